@@ -0,0 +1,226 @@
+# The MIT License (MIT)
+# Copyright (c) 2017 Levak Borok <levak92@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+## Table of the bot commands. Each command is registered once with its
+## aliases, the permission it needs and the arguments it takes, so that a
+## message is dispatched with a single lookup and parsed once.
+
+import time
+import asyncio
+
+from rolekeeper import RoleKeeper
+from outbound import lane, INTERACTIVE
+
+# Permission needed to use a command
+ADMIN = 'admin'
+REF = 'ref'
+CAPTAIN = 'captain'
+STREAMER = 'streamer'
+
+# Returned by a command when its arguments are wrong, to reply its usage
+USAGE = object()
+
+class Command:
+    def __init__(self, name, handler, level, aliases=(), usage=None, min_parts=0, reuse=False, tokens=False, serial=False, priority=INTERACTIVE):
+        self.name = name
+        self.handler = handler
+        self.level = level
+        self.aliases = aliases
+        self.usage = usage
+        self.min_parts = min_parts
+
+        # Accepts a trailing `reuse` or `new`
+        self.reuse = reuse
+
+        # Accepts `>category` and `?cup` anywhere in the arguments
+        self.tokens = tokens
+
+        # Acts on the match of the channel, one command at a time
+        self.serial = serial
+
+        # Priority of the Discord requests it sends (see outbound.py)
+        self.priority = priority
+
+### A message parsed for the command it calls
+class Invocation:
+    def __init__(self, message, command, args, is_admin, is_ref, is_streamer, is_captain_in_match):
+        self.message = message
+        self.command = command
+        self.args = args
+        self.parts = []
+        self.category = None
+        self.cup = None
+        self.reuse = RoleKeeper.REUSE_UNK
+
+        self.is_admin = is_admin
+        self.is_ref = is_ref
+        self.is_streamer = is_streamer
+        self.is_captain_in_match = is_captain_in_match
+
+    def allowed(self, level):
+        return { ADMIN: self.is_admin,
+                 REF: self.is_ref,
+                 CAPTAIN: self.is_captain_in_match,
+                 STREAMER: self.is_streamer }[level]
+
+    def parse(self, cmd):
+        args = self.args.strip()
+
+        if cmd.reuse:
+            if args.endswith(' reuse'):
+                self.reuse = RoleKeeper.REUSE_YES
+                args = args[:-6]
+            elif args.endswith(' new'):
+                self.reuse = RoleKeeper.REUSE_NO
+                args = args[:-4]
+
+        self.args = args
+        self.parts = args.split()
+
+        if cmd.tokens:
+            parts = []
+            for part in self.parts:
+                if part.startswith('>') and self.category is None:
+                    self.category = part[1:]
+                elif part.startswith('?') and self.cup is None:
+                    self.cup = part[1:]
+                else:
+                    parts.append(part)
+            self.parts = parts
+
+    def part(self, i, default=''):
+        return self.parts[i] if len(self.parts) > i else default
+
+    def attachment(self):
+        return self.message.attachments[0] if len(self.message.attachments) > 0 else None
+
+### How often a command was used and how long it took
+class CommandStats:
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, elapsed):
+        self.count += 1
+        self.total += elapsed
+        self.max = max(self.max, elapsed)
+
+    def __str__(self):
+        return '{count} calls, {total:.2f}s total, {avg:.3f}s avg, {max:.3f}s max'\
+            .format(count=self.count,
+                    total=self.total,
+                    avg=self.total / self.count if self.count else 0,
+                    max=self.max)
+
+### Commands acting on the match of a channel run one at a time, in the
+### order they were received, so that two of them cannot play the same turn
+class ChannelQueue:
+    def __init__(self, name):
+        self.name = name
+        self.lock = asyncio.Lock()
+
+        # Commands running or waiting
+        self.depth = 0
+        self.max_depth = 0
+
+        self.count = 0
+        self.total_wait = 0
+        self.max_wait = 0
+
+    def waited(self, elapsed):
+        self.count += 1
+        self.total_wait += elapsed
+        self.max_wait = max(self.max_wait, elapsed)
+
+    def __str__(self):
+        return '{count} calls, {depth} queued, {max_depth} max queued, {avg:.3f}s avg wait, {max:.3f}s max wait'\
+            .format(count=self.count,
+                    depth=self.depth,
+                    max_depth=self.max_depth,
+                    avg=self.total_wait / self.count if self.count else 0,
+                    max=self.max_wait)
+
+class CommandRegistry:
+    def __init__(self):
+        self.commands = {}
+        self.stats = {}
+
+        # Serial command queues, by channel ID
+        self.channels = {}
+
+    ## Decorator registering a command handler
+    def command(self, name, level, **kwargs):
+        def register(handler):
+            cmd = Command(name, handler, level, **kwargs)
+            for alias in (name,) + tuple(cmd.aliases):
+                self.commands[alias] = cmd
+            self.stats[name] = CommandStats()
+            return handler
+
+        return register
+
+    def get(self, command):
+        return self.commands.get(command)
+
+    ## Parse the arguments once and run the command, timing it
+    async def dispatch(self, cmd, inv):
+        inv.parse(cmd)
+
+        if len(inv.parts) < cmd.min_parts:
+            return USAGE
+
+        if not cmd.serial:
+            return await self.run(cmd, inv)
+
+        channel = inv.message.channel
+        if channel.id not in self.channels:
+            self.channels[channel.id] = ChannelQueue(channel.name)
+        queue = self.channels[channel.id]
+
+        queue.depth += 1
+        queue.max_depth = max(queue.max_depth, queue.depth)
+
+        start = time.perf_counter()
+        try:
+            async with queue.lock:
+                queue.waited(time.perf_counter() - start)
+                return await self.run(cmd, inv)
+        finally:
+            queue.depth -= 1
+
+    async def run(self, cmd, inv):
+        start = time.perf_counter()
+        try:
+            with lane(cmd.priority):
+                return await cmd.handler(inv)
+        finally:
+            self.stats[cmd.name].add(time.perf_counter() - start)
+
+    ## Forget the queue of a deleted channel
+    def drop_channel(self, channel):
+        queue = self.channels.get(channel.id)
+        if queue and queue.depth == 0:
+            del self.channels[channel.id]
+
+    def usage(self, cmd, inv):
+        return cmd.usage.format(command=inv.command) if cmd.usage else inv.command
@@ -1,7 +1,1128 @@
 import shelve
+import dbm
 import os
+import io
+import pickle
+import struct
+import hashlib
+import threading
+import concurrent.futures
+import time
+import weakref
+import types
+import json
+import urllib.parse
+import sqlite3
 
-def open_db(name):
+from team import CustomRole, TeamCaptain
+from tracked import Tracked, TrackedDict
+
+## The guild state is saved as many small records instead of one big pickle:
+##
+##   ('.', key)                      -> top-level value (e.g. 'bcast')
+##   ('manifest',)                   -> list of the cups
+##   ('cups', cup, '.', field)       -> cup field (e.g. 'cup', 'hunt', 'driver')
+##   ('cups', cup, section)          -> None, tells the section exists
+##   ('cups', cup, section, key)     -> one captain, team, group, match or reward
+##   ('obj', cup, uid)               -> a shared object (see SHARED_TYPES)
+##
+## Top-level records and the manifest listing the cups go to the guild
+## store (db/<name>), the records of each cup to a store of their own
+## (db/<name>.cups/<cup>), so that saving, compacting or dropping a cup never
+## touches the bytes of another one.
+##
+## Each save copies the records that changed on the event loop (see freeze),
+## then pickles, diffs and writes them in a worker thread to the stores, either
+## journal files regularly folded into snapshot files in a background thread
+## (JournalStore), or an SQLite table of pickled records keyed by their
+## pickled path (SQLiteStore).
+
+# Objects referenced from several records (a captain is referenced by the
+# captain list, by its team and by its rewards). They are stored once in
+# their own record and referenced everywhere else, so that they are still
+# the same object once reloaded.
+SHARED_TYPES = (CustomRole, TeamCaptain)
+
+# Record of the guild store listing the cups, each cup having its own store
+MANIFEST = ('manifest',)
+
+# Cup entries stored as one record per item
+SECTIONS = ('captains', 'teams', 'groups', 'matches', 'rewards')
+
+# Cup indexes rebuilt from the captain list when loading
+DERIVED = ('captains-by-nick', 'captains-by-team')
+
+# Don't bother compacting journals smaller than that
+COMPACT_MIN_SIZE = 1024 * 1024
+
+def digest(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+# Types pickled as they are, their instances never change
+ATOMIC = frozenset([ type(None), bool, int, float, complex, str, bytes ])
+
+## Shared object referenced by a frozen record, pickled as its persistent ID
+class Ref:
+    def __init__(self, cls, uid):
+        self.cls = cls
+        self.uid = uid
+
+## Copy of an object taken on the event loop, pickled by the writer thread
+## exactly like the object it was taken from
+class Frozen:
+    def __init__(self, cls):
+        self.cls = cls
+        self.reduced = None
+
+    # Pickle checks the class of the objects it builds with __newobj__
+    @property
+    def __class__(self):
+        return self.cls
+
+class RecordPickler(pickle.Pickler):
+    def __init__(self, file):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def persistent_id(self, obj):
+        if type(obj) is Ref:
+            return (obj.cls, obj.uid)
+
+        return None
+
+    def reducer_override(self, obj):
+        if type(obj) is not Frozen:
+            return NotImplemented
+
+        func, args, state, listitems, dictitems, setter = obj.reduced
+        return (func, args, state,
+                iter(listitems) if listitems is not None else None,
+                iter(dictitems) if dictitems is not None else None,
+                setter)
+
+class RecordUnpickler(pickle.Unpickler):
+    def __init__(self, file, objects):
+        super().__init__(file)
+        self.objects = objects
+
+    def persistent_load(self, pid):
+        cls, uid = pid
+
+        # The object record may not be loaded yet, create an empty one that
+        # will be filled later
+        if uid not in self.objects:
+            self.objects[uid] = cls.__new__(cls)
+
+        return self.objects[uid]
+
+## Append-only journal of records, folded into a snapshot file
+class JournalStore:
+    HEADER = struct.Struct('>Ii')
+
+    def __init__(self, path):
+        self.path = path
+        self.snapshot_path = '{}.snapshot'.format(path)
+        self.journal_path = '{}.journal'.format(path)
+        self.compacting_path = '{}.compacting'.format(path)
+
+        self.lock = threading.Lock()
+        self.compactor = None
+        self.journal = None
+
+    def exists(self):
+        return os.path.exists(self.snapshot_path) \
+            or os.path.exists(self.journal_path) \
+            or os.path.exists(self.compacting_path)
+
+    @classmethod
+    def write_entry(cls, f, path, data):
+        f.write(cls.HEADER.pack(len(path), len(data) if data is not None else -1))
+        f.write(path)
+        if data is not None:
+            f.write(data)
+
+    @classmethod
+    def read_entries(cls, filename, records):
+        if not os.path.exists(filename):
+            return records
+
+        with open(filename, 'rb') as f:
+            while True:
+                header = f.read(cls.HEADER.size)
+                if len(header) < cls.HEADER.size:
+                    break
+
+                path_len, data_len = cls.HEADER.unpack(header)
+                path = f.read(path_len)
+                data = f.read(data_len) if data_len >= 0 else None
+
+                # Torn write at the end of the file, the rest is lost
+                if len(path) < path_len or (data is not None and len(data) < data_len):
+                    print('WARNING: Truncated entry at the end of "{}"'.format(filename))
+                    break
+
+                if data is None:
+                    records.pop(path, None)
+                else:
+                    records[path] = data
+
+        return records
+
+    def load(self):
+        records = {}
+        self.read_entries(self.snapshot_path, records)
+        self.read_entries(self.compacting_path, records)
+        self.read_entries(self.journal_path, records)
+
+        # We stopped in the middle of a compaction, finish it now
+        if os.path.exists(self.compacting_path):
+            self.write_snapshot(records)
+            os.remove(self.compacting_path)
+            if os.path.exists(self.journal_path):
+                os.remove(self.journal_path)
+
+        return records
+
+    def append(self, puts, dels):
+        if len(puts) == 0 and len(dels) == 0:
+            return 0
+
+        with self.lock:
+            if not self.journal:
+                self.journal = open(self.journal_path, 'ab')
+
+            buffer = io.BytesIO()
+            for path in dels:
+                self.write_entry(buffer, path, None)
+            for path, record in puts.items():
+                self.write_entry(buffer, path, record.data)
+
+            self.journal.write(buffer.getvalue())
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+
+            size = self.journal.tell()
+
+        if size > COMPACT_MIN_SIZE and size > self.snapshot_size():
+            self.compact()
+
+        return len(buffer.getvalue())
+
+    def snapshot_size(self):
+        try:
+            return os.path.getsize(self.snapshot_path)
+        except OSError:
+            return 0
+
+    def write_snapshot(self, records):
+        tmp_path = '{}.tmp'.format(self.snapshot_path)
+        with open(tmp_path, 'wb') as f:
+            for path, data in records.items():
+                self.write_entry(f, path, data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+
+    def compact_task(self):
+        try:
+            records = {}
+            self.read_entries(self.snapshot_path, records)
+            self.read_entries(self.compacting_path, records)
+            self.write_snapshot(records)
+            os.remove(self.compacting_path)
+            print('Compacted "{}" ({} records)'.format(self.path, len(records)))
+        except:
+            import traceback
+            traceback.print_exc()
+            print('ERROR Failed to compact "{}"'.format(self.path))
+
+    ## Fold the journal into the snapshot in a background thread
+    def compact(self, wait=False):
+        with self.lock:
+            if self.compactor and self.compactor.is_alive():
+                compactor = self.compactor
+            elif not os.path.exists(self.journal_path):
+                compactor = None
+            else:
+                if self.journal:
+                    self.journal.close()
+                    self.journal = None
+
+                # New entries go to a fresh journal while we compact
+                os.replace(self.journal_path, self.compacting_path)
+
+                compactor = threading.Thread(target=self.compact_task,
+                                             name='compact-{}'.format(self.path))
+                self.compactor = compactor
+                compactor.start()
+
+        if wait and compactor:
+            compactor.join()
+
+    def close(self):
+        self.compact(wait=True)
+
+        with self.lock:
+            if self.journal:
+                self.journal.close()
+                self.journal = None
+
+    ## Remove the files of the store
+    def destroy(self):
+        with self.lock:
+            compactor = self.compactor
+
+        if compactor:
+            compactor.join()
+
+        with self.lock:
+            if self.journal:
+                self.journal.close()
+                self.journal = None
+
+            for filename in [ self.snapshot_path, self.journal_path, self.compacting_path ]:
+                if os.path.exists(filename):
+                    os.remove(filename)
+
+## SQLite database of records
+##
+## A plain blob store: one table mapping the pickled path of each record to
+## its pickled value. Lookups are served by the in-memory indexes of the bot
+## and each cup has a database of its own, nothing queries the records by
+## their content.
+class SQLiteStore:
+    # Tables of the older per-kind layout, folded into the records table
+    LEGACY_TABLES = ('cups', 'groups', 'teams', 'captains', 'matches')
+
+    def __init__(self, path):
+        self.path = path
+        self.sqlite_path = '{}.sqlite'.format(path)
+        self.conn = None
+
+    def exists(self):
+        return os.path.exists(self.sqlite_path)
+
+    def connect(self):
+        if self.conn:
+            return self.conn
+
+        # Writes happen in the writer thread of the guild DB
+        self.conn = sqlite3.connect(self.sqlite_path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=FULL')
+
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS records '
+                              '(path BLOB PRIMARY KEY, data BLOB NOT NULL)')
+
+            tables = set(name for name, in self.conn.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table'"))
+            for table in self.LEGACY_TABLES:
+                if table in tables:
+                    self.conn.execute('INSERT OR REPLACE INTO records (path, data) '
+                                      'SELECT path, data FROM {}'.format(table))
+                    self.conn.execute('DROP TABLE {}'.format(table))
+
+        return self.conn
+
+    def load(self):
+        conn = self.connect()
+        return dict(conn.execute('SELECT path, data FROM records'))
+
+    def append(self, puts, dels):
+        if len(puts) == 0 and len(dels) == 0:
+            return 0
+
+        conn = self.connect()
+        written = 0
+
+        with conn:
+            conn.executemany('DELETE FROM records WHERE path = ?',
+                             [ (path,) for path in dels ])
+
+            for path, record in puts.items():
+                conn.execute('INSERT OR REPLACE INTO records (path, data) VALUES (?, ?)',
+                             (path, record.data))
+                written += len(record.data)
+
+        return written
+
+    def compact(self, wait=False):
+        if self.conn:
+            self.conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    def close(self):
+        if self.conn:
+            self.compact()
+            self.conn.close()
+            self.conn = None
+
+    ## Remove the files of the store
+    def destroy(self):
+        if self.conn:
+            self.conn.close()
+            self.conn = None
+
+        for suffix in [ '', '-wal', '-shm' ]:
+            filename = self.sqlite_path + suffix
+            if os.path.exists(filename):
+                os.remove(filename)
+
+## Append-only log of the actions done in matches, replayed when loading so
+## that they survive a crash until the next save
+class ActionLog:
+    def __init__(self, path):
+        self.path = '{}.actions'.format(path)
+        self.lock = threading.Lock()
+        self.file = None
+        self.seq = 0
+
+        # Actions written but not fsynced yet
+        self.unsynced = False
+
+        # Actions not in the stores yet
+        self.events = []
+
+    def load(self):
+        events = []
+        torn = False
+
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                for line in f:
+                    try:
+                        events.append(json.loads(line))
+                    except ValueError:
+                        torn = True
+                        break
+
+        with self.lock:
+            self.events = events
+            self.seq = max([ event['seq'] for event in events ], default=0)
+
+            # Torn write at the end of the file, drop it before appending
+            if torn:
+                print('WARNING: Truncated action at the end of "{}"'.format(self.path))
+                self.rewrite(events)
+
+        return events
+
+    def append(self, event):
+        with self.lock:
+            self.seq += 1
+            event['seq'] = self.seq
+
+            if not self.file:
+                self.file = open(self.path, 'a')
+
+            # Flushed to the OS right away, it survives the bot crashing,
+            # fsynced later by the writer thread (see fsync)
+            self.file.write(json.dumps(event) + '\n')
+            self.file.flush()
+            self.unsynced = True
+
+            self.events.append(event)
+
+    def fsync(self):
+        with self.lock:
+            if self.file and self.unsynced:
+                os.fsync(self.file.fileno())
+            self.unsynced = False
+
+    ## Forget the actions up to seq, they are in the stores now
+    def truncate(self, seq):
+        with self.lock:
+            events = [ event for event in self.events if event['seq'] > seq ]
+            if len(events) < len(self.events):
+                self.rewrite(events)
+                self.events = events
+
+    def rewrite(self, events):
+        if self.file:
+            self.file.close()
+            self.file = None
+        self.unsynced = False
+
+        tmp_path = '{}.tmp'.format(self.path)
+        with open(tmp_path, 'w') as f:
+            for event in events:
+                f.write(json.dumps(event) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def close(self):
+        self.fsync()
+
+        with self.lock:
+            if self.file:
+                self.file.close()
+                self.file = None
+
+## A record ready to be written
+class Record:
+    def __init__(self, data):
+        self.data = data
+
+## Guild database, saved record by record in a store
+##
+## Cups are tracked: changing a field of a cup, an item of one of its
+## sections or one of the objects it holds marks that record dirty, and only
+## dirty records are dumped when saving. Cups added, removed or with a
+## section replaced are dumped whole.
+##
+## Changes made in place to plain containers are not seen, the cups touched
+## since the last check are dumped whole and diffed when checking (see
+## sync_background), so that they are saved all the same.
+class GuildDB(dict):
+    def __init__(self, path, store_cls, legacy_path=None, legacy_classes=[]):
+        dict.__init__(self)
+
+        self.path = path
+        self.shards_path = '{}.cups'.format(path)
+        self.store_cls = store_cls
+
+        # Store of each cup, None being the guild store
+        self.stores = { None: store_cls(path) }
+
+        if not os.path.isdir(self.shards_path):
+            os.mkdir(self.shards_path)
+
+        # Unique IDs of shared objects
+        self.uids = weakref.WeakKeyDictionary()
+        self.next_uid = 1
+
+        # Digest of every record as it is on disk, by store
+        self.digests = {}
+
+        # What changed since the last save: top-level records, whole cups,
+        # records and shared objects of each cup
+        self.dirty = False
+        self.dirty_cups = set()
+        self.dirty_records = {}
+        self.dirty_objects = {}
+
+        # Cups touched since the last check
+        self.touched = set()
+
+        # UIDs of the shared objects saved in the store of each cup
+        self.saved = {}
+
+        # Snapshots are written one after another, in the order they were
+        # taken, by a single thread
+        self.writer = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.write_lock = threading.Lock()
+
+        # Time the last snapshot blocked the event loop
+        self.blocked = 0
+
+        self.actions = ActionLog(path)
+        self.actions_fsync = False
+
+        legacy_cls = next((cls for cls in legacy_classes if cls(path).exists()), None)
+
+        if self.stores[None].exists():
+            self.stores, scopes = self.read_stores(store_cls)
+            self.load_records(scopes)
+        elif legacy_cls:
+            self.import_store(legacy_cls)
+        elif legacy_path and dbm.whichdb(legacy_path):
+            self.import_shelf(legacy_path)
+
+        self.replay_actions(self.actions.load())
+
+    def __setitem__(self, key, value):
+        if key == 'cups':
+            value = self.track_cups(value)
+            self.dirty_cups.update(value.keys())
+            self.dirty_cups.update(dict.get(self, 'cups', {}).keys())
+        dict.__setitem__(self, key, value)
+        self.dirty = True
+
+    def __delitem__(self, key):
+        if key == 'cups':
+            self.dirty_cups.update(dict.__getitem__(self, 'cups').keys())
+        dict.__delitem__(self, key)
+        self.dirty = True
+
+    def touch_cup(self, cup_name):
+        self.dirty_cups.add(cup_name)
+        self.touched.add(cup_name)
+
+    def touch_record(self, cup_name, path):
+        self.dirty_records.setdefault(cup_name, set()).add(path)
+        self.touched.add(cup_name)
+
+    # Objects are kept by ID, whatever their notion of equality
+    def touch_object(self, cup_name, obj):
+        self.dirty_objects.setdefault(cup_name, {})[id(obj)] = obj
+        self.touched.add(cup_name)
+
+    # Replacing a whole section dumps the whole cup
+    def touch_field(self, cup_name, field):
+        if field in SECTIONS:
+            self.touch_cup(cup_name)
+        elif field not in DERIVED:
+            self.touch_record(cup_name, ('cups', cup_name, '.', field))
+
+    # A cup was added or removed, the manifest changes too
+    def touch_cups(self, cup_name):
+        self.dirty_cups.add(cup_name)
+        self.dirty = True
+
+    def touch_all(self):
+        self.dirty = True
+        self.dirty_cups.update(self.get('cups', {}).keys())
+
+    ## Track the cup list, every cup added to it is tracked too
+    def track_cups(self, cups):
+        if isinstance(cups, TrackedDict):
+            return cups
+
+        return TrackedDict(self.touch_cups, cups, adopt=self.track_cup)
+
+    ## Track a cup, its sections and the objects in them, each change
+    ## marking the record it is saved in
+    def track_cup(self, cup_name, cup_db):
+        def adopt(path, value):
+            if isinstance(value, SHARED_TYPES):
+                value.track(lambda: self.touch_object(cup_name, value))
+            elif isinstance(value, Tracked):
+                value.track(lambda: self.touch_record(cup_name, path))
+            return value
+
+        def adopt_section(field, section):
+            return TrackedDict(lambda key: self.touch_record(cup_name, ('cups', cup_name, field, key)),
+                               section,
+                               adopt=lambda key, item: adopt(('cups', cup_name, field, key), item))
+
+        def adopt_field(field, value):
+            if field in SECTIONS and isinstance(value, dict):
+                return adopt_section(field, value)
+            return adopt(('cups', cup_name, '.', field), value)
+
+        return TrackedDict(lambda field: self.touch_field(cup_name, field), cup_db,
+                           adopt=adopt_field)
+
+    def shard_path(self, cup_name):
+        filename = urllib.parse.quote(cup_name, safe='').replace('.', '%2E')
+        return os.path.join(self.shards_path, filename)
+
+    ## Store of a cup, created when needed
+    def store(self, cup_name):
+        store = self.stores.get(cup_name)
+        if store is None:
+            store = self.store_cls(self.shard_path(cup_name))
+
+            # Leftover of a cup dropped before it got in the manifest
+            if store.exists():
+                store.destroy()
+
+            self.stores[cup_name] = store
+
+        return store
+
+    ## Load the guild store and the stores of the cups in its manifest
+    def read_stores(self, cls):
+        stores = { None: cls(self.path) }
+        scopes = { None: stores[None].load() }
+
+        manifest = scopes[None].get(self.encode(MANIFEST))
+        for cup_name in self.decode(manifest, {}) if manifest else []:
+            stores[cup_name] = cls(self.shard_path(cup_name))
+            scopes[cup_name] = stores[cup_name].load()
+
+        return stores, scopes
+
+    ## Import a DB saved with another storage
+    def import_store(self, legacy_cls):
+        print('Importing DB "{}" from {}'.format(self.path, legacy_cls.__name__))
+
+        legacy_stores, scopes = self.read_stores(legacy_cls)
+        self.load_records(scopes)
+        for store in legacy_stores.values():
+            store.close()
+
+        # Nothing is in the new stores yet
+        self.digests = {}
+        self.touch_all()
+        self.sync()
+
+    ## Import a DB saved by an older version
+    def import_shelf(self, legacy_path):
+        print('Importing legacy DB "{}"'.format(legacy_path))
+
+        shelf = shelve.open(legacy_path, flag='r')
+        try:
+            for key in shelf.keys():
+                self[key] = shelf[key]
+        finally:
+            shelf.close()
+
+        for cup_db in self.get('cups', {}).values():
+            self.rebuild_indexes(cup_db)
+
+        self.touch_all()
+        self.sync()
+
+    def ref(self, obj):
+        uid = self.uids.get(obj)
+        if uid is None:
+            uid = self.next_uid
+            self.next_uid += 1
+            self.uids[obj] = uid
+
+        if uid not in self.dumped:
+            self.dumped.add(uid)
+            self.pending.append(obj)
+
+        return uid
+
+    def encode(self, value):
+        buffer = io.BytesIO()
+        RecordPickler(buffer).dump(value)
+        return buffer.getvalue()
+
+    ## Copy of a record taken on the event loop, that the writer thread can
+    ## pickle while the record keeps changing
+    ##
+    ## Objects are copied through __reduce_ex__, that is their __getstate__
+    ## and nothing more, and shared objects other than root are replaced by
+    ## their UID.
+    def freeze(self, value, root=None):
+        # Keeps the objects copied alive, their IDs are not reused meanwhile
+        memo = {}
+
+        def freeze(value):
+            cls = type(value)
+            if cls in ATOMIC:
+                return value
+
+            key = id(value)
+            if key in memo:
+                return memo[key][1]
+
+            if value is not root and isinstance(value, SHARED_TYPES):
+                frozen = Ref(cls, self.ref(value))
+            elif cls is tuple:
+                frozen = tuple(freeze(item) for item in value)
+            elif cls is list:
+                frozen = []
+                memo[key] = (value, frozen)
+                frozen.extend(freeze(item) for item in value)
+            elif cls is dict:
+                frozen = {}
+                memo[key] = (value, frozen)
+                for k, v in value.items():
+                    frozen[freeze(k)] = freeze(v)
+            elif cls in (set, frozenset):
+                frozen = cls(freeze(item) for item in value)
+            elif isinstance(value, type) \
+                 or cls in (types.FunctionType, types.BuiltinFunctionType):
+                return value
+            else:
+                reduced = value.__reduce_ex__(pickle.HIGHEST_PROTOCOL)
+
+                # Global, pickled by name
+                if isinstance(reduced, str):
+                    return value
+
+                frozen = Frozen(cls)
+                memo[key] = (value, frozen)
+
+                func, args, state, listitems, dictitems, setter = \
+                    tuple(reduced) + (None,) * (6 - len(reduced))
+                frozen.reduced = (func, freeze(args), freeze(state),
+                                  [ freeze(item) for item in listitems ] \
+                                  if listitems is not None else None,
+                                  [ (freeze(k), freeze(v)) for k, v in dictitems ] \
+                                  if dictitems is not None else None,
+                                  setter)
+
+            memo[key] = (value, frozen)
+            return frozen
+
+        return freeze(value)
+
+    ## Pickle records frozen by a snapshot
+    def thaw(self, frozen):
+        return { self.encode(path): Record(self.encode(value)) for path, value in frozen }
+
+    def decode(self, data, objects):
+        return RecordUnpickler(io.BytesIO(data), objects).load()
+
+    ## Iterate over all records of a cup
+    def walk_cup(self, cup_name, cup_db):
+        for field, value in cup_db.items():
+            if field in DERIVED:
+                continue
+
+            if field in SECTIONS and isinstance(value, dict):
+                yield ('cups', cup_name, field), None
+                for key, item in value.items():
+                    yield ('cups', cup_name, field, key), item
+            else:
+                yield ('cups', cup_name, '.', field), value
+
+    def dump_record(self, records, path, value, root=None):
+        records.append((self.freeze(path), self.freeze(value, root=root)))
+
+    def dump_top(self):
+        records = []
+        self.dumped = set()
+        self.pending = []
+
+        for key, value in self.items():
+            if key != 'cups':
+                self.dump_record(records, ('.', key), value)
+
+        self.dump_record(records, MANIFEST, sorted(self.get('cups', {}).keys()))
+
+        return records
+
+    def dump_cup(self, cup_name, cup_db):
+        records = []
+        self.dumped = set()
+        self.pending = []
+
+        for path, value in self.walk_cup(cup_name, cup_db):
+            self.dump_record(records, path, value)
+
+        self.dump_pending(records, cup_name)
+        self.saved[cup_name] = self.dumped
+
+        return records
+
+    ## Dump the records of a cup that changed, returns them along with the
+    ## paths of the records removed
+    def dump_changes(self, cup_name, cup_db, paths, objects):
+        records = []
+        removed = []
+
+        # Shared objects already saved are only dumped if they changed
+        self.dumped = set(self.saved.get(cup_name, ()))
+        self.pending = []
+
+        for path in paths:
+            found, value = self.lookup(cup_db, path)
+            if found:
+                self.dump_record(records, path, value)
+            else:
+                removed.append(self.freeze(path))
+
+        for obj in objects.values():
+            if self.uids.get(obj) in self.dumped:
+                self.pending.append(obj)
+            else:
+                self.ref(obj)
+
+        self.dump_pending(records, cup_name)
+        self.saved[cup_name] = self.dumped
+
+        return records, removed
+
+    ## Shared objects met while pickling the records of a cup
+    def dump_pending(self, records, cup_name):
+        while len(self.pending) > 0:
+            obj = self.pending.pop()
+            self.dump_record(records, ('obj', cup_name, self.uids[obj]), obj, root=obj)
+
+    ## Value of the record of a cup at path, if it is still there
+    @staticmethod
+    def lookup(cup_db, path):
+        if path[2] == '.':
+            return path[3] in cup_db, cup_db.get(path[3])
+
+        section = cup_db.get(path[2])
+        if not isinstance(section, dict):
+            return False, None
+
+        return path[3] in section, section.get(path[3])
+
+    ## Load the records of each store
+    def load_records(self, scopes):
+        objects = {}
+        cups = {}
+
+        # Cups saved in the guild store before it was sharded
+        unsharded = set()
+
+        for scope, records in scopes.items():
+            digests = self.digests.setdefault(scope, {})
+
+            for path_data, data in records.items():
+                path = self.decode(path_data, objects)
+                value = self.decode(data, objects)
+                digests[path_data] = digest(data)
+
+                if scope is None and path[0] in ('cups', 'obj') and len(path) > 2:
+                    unsharded.add(path[1])
+
+                if path[0] == 'obj':
+                    uid = path[-1]
+                    self.saved.setdefault(scope, set()).add(uid)
+                    shell = objects.setdefault(uid, value)
+                    if shell is not value:
+                        shell.__dict__.update(value.__dict__)
+                elif path[0] == '.':
+                    self[path[1]] = value
+                elif path[0] == 'cups':
+                    cup_db = cups.setdefault(path[1], {})
+                    if len(path) == 3:
+                        cup_db.setdefault(path[2], {})
+                    elif path[2] == '.':
+                        cup_db[path[3]] = value
+                    else:
+                        cup_db.setdefault(path[2], {})[path[3]] = value
+
+        for uid, obj in objects.items():
+            self.uids[obj] = uid
+            self.next_uid = max(self.next_uid, uid + 1)
+
+        for cup_db in cups.values():
+            self.rebuild_indexes(cup_db)
+
+        if len(cups) > 0:
+            self['cups'] = cups
+
+        # Everything is as it is on disk, but cups still in the guild store
+        # that have to be moved to their own store
+        self.dirty = len(unsharded) > 0
+        self.dirty_cups = unsharded & set(cups.keys())
+        self.dirty_records = {}
+        self.dirty_objects = {}
+        self.touched = set()
+
+        print('Loaded {} records from "{}" ({} cups)'\
+              .format(sum(len(records) for records in scopes.values()),
+                      self.path, len(cups)))
+
+    def rebuild_indexes(self, cup_db):
+        if 'captains' not in cup_db:
+            return
+
+        captains = cup_db['captains'].values()
+        cup_db['captains-by-nick'] = { c.nickname: c for c in captains }
+        cup_db['captains-by-team'] = { c.team_name: c for c in captains }
+
+    ## Compare records to what is on disk, returns the new digests
+    @staticmethod
+    def diff(old_digests, records, puts, dels):
+        digests = {}
+        for path, record in records.items():
+            digests[path] = digest(record.data)
+            if old_digests.get(path) != digests[path]:
+                puts[path] = record
+
+        dels.extend(path for path in old_digests if path not in records)
+
+        return digests
+
+    ## Take a point-in-time copy of what changed since the last save
+    ##
+    ## This runs on the event loop, it only copies the dirty records, or the
+    ## whole cups touched since the last check when checking. Pickling,
+    ## diffing and writing to the disk is done by write() in the writer
+    ## thread.
+    def snapshot(self, check=False):
+        if check:
+            self.dirty_cups.update(self.touched)
+            self.touched = set()
+
+        if not self.dirty and len(self.dirty_cups) == 0 \
+           and len(self.dirty_records) == 0 and len(self.dirty_objects) == 0:
+            return None
+
+        start = time.perf_counter()
+        snapshot = Snapshot()
+
+        dirty, self.dirty = self.dirty, False
+        dirty_cups, self.dirty_cups = self.dirty_cups, set()
+        dirty_records, self.dirty_records = self.dirty_records, {}
+        dirty_objects, self.dirty_objects = self.dirty_objects, {}
+
+        if dirty:
+            snapshot.scopes[None] = self.dump_top()
+
+        cups = self.get('cups', {})
+        for cup_name in dirty_cups:
+            cup_db = cups.get(cup_name)
+            if cup_db is not None:
+                snapshot.scopes[cup_name] = self.dump_cup(cup_name, cup_db)
+            else:
+                snapshot.scopes[cup_name] = None
+                self.saved.pop(cup_name, None)
+
+        for cup_name in (dirty_records.keys() | dirty_objects.keys()) - dirty_cups:
+            cup_db = cups.get(cup_name)
+            if cup_db is not None:
+                snapshot.changes[cup_name] = \
+                    self.dump_changes(cup_name, cup_db,
+                                      dirty_records.get(cup_name, ()),
+                                      dirty_objects.get(cup_name, {}))
+
+        snapshot.cups = len(cups)
+        snapshot.actions_seq = self.actions.seq
+        snapshot.blocked = time.perf_counter() - start
+        self.blocked = snapshot.blocked
+
+        return snapshot
+
+    ## Write the records of a snapshot that changed to their stores
+    def write(self, snapshot):
+        with self.write_lock:
+            count = 0
+            written = 0
+            dumped = 0
+            dropped = []
+
+            # Cups partly dumped, only their removed records are deleted
+            for scope, (frozen, removed) in snapshot.changes.items():
+                records = self.thaw(frozen)
+                digests = self.digests.setdefault(scope, {})
+                puts = {}
+                dels = [ path for path in map(self.encode, removed)
+                         if digests.pop(path, None) is not None ]
+                dumped += len(records)
+                for path, record in records.items():
+                    data_digest = digest(record.data)
+                    if digests.get(path) != data_digest:
+                        digests[path] = data_digest
+                        puts[path] = record
+                written += self.store(scope).append(puts, dels)
+                count += len(puts) + len(dels)
+
+            # Cups go first, so that the manifest never lists a cup that
+            # is not written yet
+            for scope in sorted(snapshot.scopes, key=lambda scope: scope is None):
+                if snapshot.scopes[scope] is None:
+                    dropped.append(scope)
+                    continue
+
+                records = self.thaw(snapshot.scopes[scope])
+                puts = {}
+                dels = []
+                dumped += len(records)
+                self.digests[scope] = self.diff(self.digests.get(scope, {}), records, puts, dels)
+                written += self.store(scope).append(puts, dels)
+                count += len(puts) + len(dels)
+
+            # The manifest no longer lists them, drop their stores
+            for scope in dropped:
+                self.digests.pop(scope, None)
+                store = self.stores.pop(scope, None)
+                if store:
+                    store.destroy()
+                    print('Dropped cup "{}" from "{}"'.format(scope, self.path))
+
+            self.actions.truncate(snapshot.actions_seq)
+
+        if count > 0:
+            print('Saved {} records ({} bytes) in "{}", {} objects serialized from {}/{} cups, loop blocked {:.1f} ms'\
+                  .format(count, written, self.path,
+                          dumped,
+                          len([ s for s in snapshot.scopes if s is not None ]) + len(snapshot.changes),
+                          snapshot.cups, snapshot.blocked * 1000))
+
+        return written
+
+    ## Save what changed right away
+    def sync(self, check=False):
+        snapshot = self.snapshot(check)
+        if snapshot:
+            self.write(snapshot)
+
+    ## Take a snapshot now and write it in the writer thread, returns a
+    ## future or None if nothing changed
+    ##
+    ## When checking, the cups touched since the last check are dumped
+    ## whole, to save what was changed in place without being seen.
+    def sync_background(self, check=False):
+        snapshot = self.snapshot(check)
+        if snapshot is None:
+            return None
+
+        return self.writer.submit(self.write, snapshot)
+
+    ## Fold the journals into their snapshot, or checkpoint SQLite, once
+    ## pending writes are done
+    def compact(self):
+        return self.writer.submit(self.compact_stores)
+
+    def compact_stores(self):
+        with self.write_lock:
+            for store in self.stores.values():
+                store.compact()
+
+    def close(self):
+        self.writer.shutdown(wait=True)
+        self.sync(check=True)
+        for store in self.stores.values():
+            store.close()
+        self.actions.close()
+
+    ## Log an action done in a match of a cup
+    def log_action(self, cup_name, channel, action, value, actor, state):
+        self.actions.append({
+            'cup': cup_name,
+            'channel': channel,
+            'turn': state[0],
+            'state': state,
+            'action': action,
+            'value': value,
+            'actor': actor,
+            'time': time.time(),
+        })
+
+        # One fsync in the writer thread for the actions logged meanwhile
+        if not self.actions_fsync:
+            self.actions_fsync = True
+            self.writer.submit(self.fsync_actions)
+
+    def fsync_actions(self):
+        self.actions_fsync = False
+        self.actions.fsync()
+
+    ## Apply the actions done since the last save, those already in the saved
+    ## state of their match are skipped
+    def replay_actions(self, events):
+        replayed = 0
+
+        for event in events:
+            cup_db = self.get('cups', {}).get(event['cup'])
+            match = cup_db.get('matches', {}).get(event['channel']) if cup_db else None
+
+            if match and hasattr(match, 'replay') and match.state_key() == event['state']:
+                match.replay(event['action'], event['value'])
+                replayed += 1
+
+        if replayed > 0:
+            print('Replayed {}/{} actions in "{}"'.format(replayed, len(events), self.path))
+
+## What changed in a guild DB at some point, ready to be written
+class Snapshot:
+    def __init__(self):
+        # Frozen records of each cup dumped whole (None for the top-level
+        # records), None when the cup was removed
+        self.scopes = {}
+
+        # Frozen records of each cup partly dumped, and the paths of those
+        # removed
+        self.changes = {}
+
+        self.cups = 0
+
+        # Last action in the snapshot
+        self.actions_seq = 0
+
+        # Time spent on the event loop to take the snapshot
+        self.blocked = 0
+
+STORES = {
+    'journal': JournalStore,
+    'sqlite': SQLiteStore,
+}
+
+def open_db(name, storage='journal'):
     db = None
 
     try:
@@ -16,7 +1137,13 @@ def open_db(name):
 
         path = os.path.join(folder, filename)
         print ('Opening DB "{}"'.format(path))
-        db = shelve.open(path, writeback=True)
+        if storage not in STORES:
+            print ('ERROR Unknown storage "{}"'.format(storage))
+            return None
+
+        base = os.path.join(folder, name)
+        legacy_classes = [ cls for key, cls in STORES.items() if key != storage ]
+        db = GuildDB(base, STORES[storage], legacy_path=path, legacy_classes=legacy_classes)
 
     except:
         import traceback
@@ -26,3 +1153,13 @@ def open_db(name):
         pass
 
     return db
+
+## Whether the DB of a guild may hold cups, without loading it
+def has_cups(name, folder='db'):
+    shards_path = os.path.join(folder, '{}.cups'.format(name))
+    if os.path.isdir(shards_path):
+        return len(os.listdir(shards_path)) > 0
+
+    # Saved by an older version, cups may be anywhere
+    return os.path.isdir(folder) \
+        and any(filename.startswith('{}.'.format(name)) for filename in os.listdir(folder))
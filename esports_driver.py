@@ -27,12 +27,15 @@ import urllib
 import datetime
 
 from handle import Handle
+from tracked import Tracked
+from outbound import lane, BULK
 
-import discord
 import bs4 as BeautifulSoup
 
 
-class EsportsDriver:
+class EsportsDriver(Tracked):
+    TRACKED = ( 'url', 'cup_name', 'cat_id', 'handle', 'status_handle', 'alive', 'started' )
+
     def __init__(self, bot, db, url, cup_name, cat_id):
         self.bot = bot
         self.guild = None
@@ -55,6 +58,7 @@ class EsportsDriver:
 
         self.match_status = {}
         self.cached_matches = {}
+        self.index_matches()
         self.handle = None
         self.status_handle = None
 
@@ -191,8 +195,8 @@ class EsportsDriver:
 
         if not match_status.channel:
             channel_name = self.get_channel(match_status.id)
-            match_status.channel = discord.utils.get(self.guild.channels,
-                                                     name=channel_name) if channel_name else None
+            match_status.channel = self.bot.get_channel(self.guild,
+                                                        channel_name) if channel_name else None
 
         if waiting:
             match_status.status = match_status.WAITING
@@ -334,9 +338,10 @@ class EsportsDriver:
             return
         self._trigger_garbage_collector = False
 
-        await self.bot.wipe_matches(self.handle.message if self.handle else None,
-                                    self.cup_name,
-                                    mode=self.bot.WIPE_AUTO)
+        with lane(BULK):
+            await self.bot.wipe_matches(self.handle.message if self.handle else None,
+                                        self.cup_name,
+                                        mode=self.bot.WIPE_AUTO)
 
     ## Display an error about a match only once.
     ##
@@ -375,6 +380,9 @@ class EsportsDriver:
         co_matches = []
         matches = bracket_dom.find_all('div', attrs={'class': u'tn_match'})
 
+        # Matches may have been created or wiped by hand since last refresh
+        self.index_matches()
+
         for match in matches:
             team1_d = match.find('div', attrs={'class': u'team1'})
             team2_d = match.find('div', attrs={'class': u'team2'})
@@ -524,32 +532,39 @@ class EsportsDriver:
                                        team1_name, team2_name, team1_icon, team2_icon,
                                        mode, date) )
 
+    ## Index the Rolekeeper matches of the cup by match ID and by team names,
+    ## so that a refresh does not go through all of them for each match
+    def index_matches(self):
+        self.matches_by_id = {}
+        self.matches_by_teams = {}
+
+        for channel_name, rk_match in self.db['matches'].items():
+            match_id = getattr(rk_match, 'match_id', None)
+            if match_id:
+                self.matches_by_id.setdefault(match_id, channel_name)
+            elif hasattr(rk_match, 'teamA') and hasattr(rk_match, 'teamB'):
+                for teams in ((rk_match.teamA.name, rk_match.teamB.name),
+                              (rk_match.teamB.name, rk_match.teamA.name)):
+                    self.matches_by_teams.setdefault(teams, []).append(channel_name)
+
     ## Get the associated Rolekeeper match for given team names and add it to
     ## internal driver cache if found.
     def get_match(self, match_id, team1_name, team2_name):
         # If we didn't find the match id in our cache, we need to find it from
         # Rolekeeper DB via match ID
         if match_id not in self.cached_matches:
-            for channel_name, rk_match in self.db['matches'].items():
-                if hasattr(rk_match, 'match_id') and rk_match.match_id == match_id:
-                    self.cache_match(match_id, channel_name)
-                    break
-        else:
-            pass
+            channel_name = self.matches_by_id.get(match_id)
+            rk_match = self.db['matches'].get(channel_name) if channel_name else None
+            if rk_match and getattr(rk_match, 'match_id', None) == match_id:
+                self.cache_match(match_id, channel_name)
 
         # We still don't have the match in cache, means it was created by hand
         if match_id not in self.cached_matches:
-            for channel_name, rk_match in self.db['matches'].items():
-                if (rk_match.teamA.name == team1_name \
-                   and rk_match.teamB.name == team2_name) \
-                    or (rk_match.teamA.name == team2_name \
-                        and rk_match.teamB.name == team1_name):
-
-                    if not hasattr(rk_match, 'match_id') or not rk_match.match_id:
-                        self.cache_match(match_id, channel_name)
-                        break
-        else:
-            pass
+            for channel_name in self.matches_by_teams.get((team1_name, team2_name), []):
+                rk_match = self.db['matches'].get(channel_name)
+                if rk_match and not getattr(rk_match, 'match_id', None):
+                    self.cache_match(match_id, channel_name)
+                    break
 
         # We found it, we can now proceed
         if match_id in self.cached_matches:
@@ -573,6 +588,7 @@ class EsportsDriver:
 
     def cache_match(self, match_id, channel_name):
         self.cached_matches[match_id] = channel_name
+        self.matches_by_id[match_id] = channel_name
         self.known_match_errors[match_id] = []
         if channel_name in self.db['matches']:
             self.db['matches'][channel_name].match_id = match_id
@@ -581,17 +597,13 @@ class EsportsDriver:
     async def create_match(self, match_id, match_url,
                            team1_name, team2_name, team1_icon, team2_icon,
                            mode, time):
-        captainA = None
-        try:
-            captainA = next(c for did, c in self.db['captains'].items() if c.team_name == team1_name)
-        except StopIteration:
+        captainA = self.bot.find_captain(self.db, team_name=team1_name)
+        if not captainA:
             await self.match_error(match_id, 'Cannot find ' + team1_name)
             return
 
-        captainB = None
-        try:
-            captainB = next(c for did, c in self.db['captains'].items() if c.team_name == team2_name)
-        except StopIteration:
+        captainB = self.bot.find_captain(self.db, team_name=team2_name)
+        if not captainB:
             await self.match_error(match_id, 'Cannot find ' + team2_name)
             return
 
@@ -22,8 +22,17 @@
 import discord
 import asyncio
 import datetime
+import collections
+
+from outbound import BROADCAST
 
 class Handle:
+    # Version of the state saved by __getstate__
+    STATE_VERSION = 1
+
+    # REST fetches done to resume handles, by guild ID
+    fetches = collections.Counter()
+
     def __init__(self, bot, message=None, member=None, channel=None):
         self.bot = bot
         self.member = member
@@ -36,6 +45,9 @@ class Handle:
 
         self.team = None
 
+        # Message not fetched yet (see defer)
+        self.pending = False
+
         if self.member and self.member.id != bot.client.user.id:
             try:
                 db, error, _ = bot.find_cup_db(self.member.guild, captain=self.member.id)
@@ -49,42 +61,51 @@ class Handle:
 
     ## Override pickle serialization
     def __getstate__(self):
-        state = dict(self.__dict__)
-
         # We cannot serialize Discord.Message because of WeakSet
-        # thus, remove them
-
-        state['bot'] = None
-
-        state['_msg_ch'] = self.message.channel.id \
-                           if self.message \
-                              and self.message.channel \
-                              else self.channel.id \
-                                   if self.channel else None
-
-        state['_msg_id'] = self.message.id \
-                           if self.message else None
-
-        state['_msg_am'] = self.message.author.id \
-                           if  self.message \
-                               and self.message.author \
-                               else self.member.id \
-                                    if self.member else None
+        # thus, only keep the IDs
+        return (self.STATE_VERSION,
+                self.message.channel.id \
+                if self.message \
+                   and self.message.channel \
+                   else self.channel.id \
+                        if self.channel else None,
+                self.message.id \
+                if self.message \
+                   else self._msg_id \
+                        if self.pending else None,
+                self.message.author.id \
+                if  self.message \
+                    and self.message.author \
+                    else self.member.id \
+                         if self.member \
+                            else self._msg_am \
+                                 if self.pending else None)
+
+    def __setstate__(self, state):
+        self.bot = None
+        self.message = None
+        self.member = None
+        self.channel = None
+        self.team = None
+        self.pending = False
 
-        state['message'] = None
-        state['member'] = None
-        state['channel'] = None
-        state['team'] = None
+        # Saved by an older version
+        if isinstance(state, dict):
+            self.__dict__.update(state)
+            return
 
-        return state
+        _, self._msg_ch, self._msg_id, self._msg_am = state
 
     ## Once the bot is ready, restore the message
     async def resume(self, guild, bot):
         channel = guild.get_channel(self._msg_ch) \
                   if self._msg_ch else None
         try:
-            message = await channel.fetch_message(self._msg_id) \
-                      if channel and self._msg_id else None
+            message = None
+            if channel and self._msg_id:
+                Handle.fetches[guild.id] += 1
+                message = await bot.outbound.call('fetch', channel.id,
+                                                  channel.fetch_message, self._msg_id)
         except:
             print('WARNING: Could not find message id {}'.format(self._msg_id))
             message = None
@@ -96,6 +117,31 @@ class Handle:
         elif channel and member:
             self.__init__(bot, channel=channel, member=member)
 
+    ## Once the bot is ready, restore what the cache has and only fetch the
+    ## message when the handle is used (see restore)
+    def defer(self, guild, bot):
+        self.bot = bot
+        self._guild = guild
+        self.channel = guild.get_channel(self._msg_ch) \
+                       if self._msg_ch else None
+        self.member = guild.get_member(self._msg_am) \
+                      if self._msg_am else None
+        self.pending = True
+
+    ## Fetch the message of a deferred handle
+    async def restore(self):
+        if self.pending is True:
+            self.pending = asyncio.ensure_future(self.resume(self._guild, self.bot))
+
+        if self.pending:
+            task = self.pending
+            await task
+            self.pending = False
+
+    @property
+    def message_id(self):
+        return self.message.id if self.message \
+            else self._msg_id if self.pending else None
 
     def clone(self):
         h = Handle(self.bot)
@@ -111,116 +157,88 @@ class Handle:
         else:
             return await self.send(msg)
 
-    async def react(self, reaction, err_count=0):
-        if not self.message:
-            return None
-
+    ## Send a request through the bot outbound scheduler, None if it failed
+    async def request(self, route, major, fn, *args, **kwargs):
         try:
-            return await self.message.add_reaction(reaction)
+            return await self.bot.outbound.call(route, major, fn, *args, **kwargs)
         except discord.errors.HTTPException as e:
             print('WARNING: HTTPexception: {}'.format(str(e)))
-            err_count += 1
-            if err_count > 5:
-                return
-            await asyncio.sleep(10)
-            return await self.react(reaction, err_count=err_count)
+            return None
+
+    async def react(self, reaction):
+        await self.restore()
 
-    async def unreact(self, reaction, user, err_count=0):
         if not self.message:
             return None
 
-        try:
-            print('removing reaction {} from {}'.format(reaction, str(user)))
-            return await self.message.remove_reaction(reaction, user)
-        except discord.errors.HTTPException as e:
-            print('WARNING: HTTPexception: {}'.format(str(e)))
-            err_count += 1
-            if err_count > 5:
-                return
-            await asyncio.sleep(10)
-            return await self.unreact(reaction, user, err_count=err_count)
+        return await self.request('reaction', self.channel.id,
+                                  self.message.add_reaction, reaction)
 
-    async def send(self, msg, err_count=0):
-        try:
-            return await self.channel.send(content=msg)
-        except discord.errors.HTTPException as e:
-            print('WARNING: HTTPexception: {}'.format(str(e)))
-            err_count += 1
-            if err_count > 5:
-                return
-            await asyncio.sleep(10)
-            return await self.send(msg, err_count=err_count)
+    async def unreact(self, reaction, user):
+        await self.restore()
 
-    async def send_file(self, file, name, msg, err_count=0):
-        try:
+        if not self.message:
+            return None
+
+        print('removing reaction {} from {}'.format(reaction, str(user)))
+        return await self.request('reaction', self.channel.id,
+                                  self.message.remove_reaction, reaction, user)
+
+    async def clear_reactions(self):
+        await self.restore()
+
+        if not self.message:
+            return None
+
+        return await self.request('reaction', self.channel.id,
+                                  self.message.clear_reactions)
+
+    async def send(self, msg):
+        return await self.request('message', self.channel.id,
+                                  self.channel.send, content=msg)
+
+    async def send_file(self, file, name, msg):
+        # A file can only be read once
+        async def send():
+            file.seek(0)
             return await self.channel.send(file=discord.File(fp=file, filename=name), content=msg)
-        except discord.errors.HTTPException as e:
-            print('WARNING: HTTPexception: {}'.format(str(e)))
-            err_count += 1
-            if err_count > 5:
-                return
-            await asyncio.sleep(10)
-            return await self.send_file(file, name, msg, err_count=err_count)
 
-    async def edit(self, msg, err_count=0):
-        try:
-            return await self.message.edit(content=msg)
-        except discord.errors.HTTPException as e:
-            print('WARNING: HTTPexception: {}'.format(str(e)))
-            err_count += 1
-            if err_count > 5:
-                return
-            await asyncio.sleep(10)
-            return await self.edit(msg, err_count=err_count)
+        return await self.request('message', self.channel.id, send)
 
-    async def embed(self, title, msg, color, fields=[], err_count=0):
-        try:
-            embed = discord.Embed(title=title,
-                                  type='rich',
-                                  description=msg,
-                                  timestamp=datetime.datetime.utcnow(),
-                                  color=color)
-            for field in fields:
-                embed.add_field(name=field['name'], value=field['value'], inline=False)
-
-            return await self.channel.send(embed=embed)
-        except discord.errors.HTTPException as e:
-            print('WARNING: HTTPexception: {}'.format(str(e)))
-            err_count += 1
-            if err_count > 5:
-                return
-            await asyncio.sleep(10)
-            return await self.embed(title, msg, color, fields=fields, err_count=err_count)
+    async def edit(self, msg):
+        await self.restore()
 
-    async def edit_embed(self, title, msg, color, fields=[], err_count=0):
-        try:
-            embed = discord.Embed(title=title,
-                                  type='rich',
-                                  description=msg,
-                                  timestamp=datetime.datetime.utcnow(),
-                                  color=color)
-            for field in fields:
-                embed.add_field(name=field['name'], value=field['value'], inline=False)
-
-            return await self.message.edit(embed=embed)
-        except discord.errors.HTTPException as e:
-            print('WARNING: HTTPexception: {}'.format(str(e)))
-            err_count += 1
-            if err_count > 5:
-                return
-            await asyncio.sleep(10)
-            return await self.edit_embed(title, msg, color, fields=fields, err_count=err_count)
+        return await self.request('message', self.channel.id,
+                                  self.message.edit, content=msg)
 
-    async def delete(self, err_count=0):
-        try:
-            return await self.message.delete()
-        except discord.errors.HTTPException as e:
-            print('WARNING: HTTPexception: {}'.format(str(e)))
-            err_count += 1
-            if err_count > 5:
-                return
-            await asyncio.sleep(10)
-            return await self.delete(err_count=err_count)
+    def make_embed(self, title, msg, color, fields):
+        embed = discord.Embed(title=title,
+                              type='rich',
+                              description=msg,
+                              timestamp=datetime.datetime.utcnow(),
+                              color=color)
+        for field in fields:
+            embed.add_field(name=field['name'], value=field['value'], inline=False)
+
+        return embed
+
+    async def embed(self, title, msg, color, fields=[]):
+        embed = self.make_embed(title, msg, color, fields)
+        return await self.request('message', self.channel.id,
+                                  self.channel.send, embed=embed)
+
+    async def edit_embed(self, title, msg, color, fields=[]):
+        await self.restore()
+
+        embed = self.make_embed(title, msg, color, fields)
+        return await self.request('message', self.channel.id,
+                                  self.message.edit, embed=embed)
+
+    async def delete(self):
+        await self.restore()
+
+        return await self.request('delete', self.channel.id,
+                                  self.message.delete)
 
     async def broadcast(self, bcast_id, msg):
         if not self.bot.is_broadcast_enabled(self.channel.guild):
@@ -234,10 +252,12 @@ class Handle:
             pass
 
         for channel_name in channels:
-            channel = discord.utils.get(self.channel.guild.channels, name=channel_name)
+            channel = self.bot.get_channel(self.channel.guild, channel_name)
             if channel:
                 try:
-                    await channel.send(content=msg)
+                    await self.bot.outbound.call('message', channel.id,
+                                                 channel.send, content=msg,
+                                                 prio=BROADCAST)
                 except:
                     print('WARNING: No permission to write in "{}"'.format(channel_name))
                     pass
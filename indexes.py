@@ -0,0 +1,285 @@
+# The MIT License (MIT)
+# Copyright (c) 2017 Levak Borok <levak92@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+## Indexes kept next to the guild DBs so that lookups done on every gateway
+## event do not have to go through all the cups.
+
+### All the indexes of a guild, built when its DB is opened
+class GuildIndex:
+    def __init__(self, guild):
+        self.names = NameIndex(guild)
+        self.holders = RoleHolders(guild.members)
+        self.captains = CaptainIndex()
+        self.matches = MatchIndex()
+        self.hunts = HuntIndex()
+        self.players = PlayerIndex()
+
+    ## Forget everything about a cup that is closed
+    def drop_cup(self, cup_name):
+        self.captains.drop_cup(cup_name)
+        self.matches.drop_cup(cup_name)
+        self.hunts.drop_cup(cup_name)
+        self.players.drop_cup(cup_name)
+
+### Captains of all the cups of a guild, by discord tag and by key (member ID
+### once they joined)
+class CaptainIndex:
+    def __init__(self):
+        self.by_discord = {}
+        self.by_key = {}
+
+        # Cup, discord tag and key each captain is indexed under
+        self.indexed = {}
+
+    ## Index a captain again after it changed or left its cup
+    def update(self, cup_name, captains, captain):
+        self.drop(captain)
+
+        if captains.get(captain.key) is not captain:
+            return
+
+        self.indexed[captain] = (cup_name, captain.discord, captain.key)
+        if captain.discord:
+            self.by_discord.setdefault(captain.discord, {})[cup_name] = captain
+        self.by_key.setdefault(captain.key, {})[cup_name] = captain
+
+    def drop(self, captain):
+        if captain not in self.indexed:
+            return
+
+        cup_name, discord, key = self.indexed.pop(captain)
+        for index, value in ((self.by_discord, discord), (self.by_key, key)):
+            entries = index.get(value)
+            if entries and entries.get(cup_name) is captain:
+                del entries[cup_name]
+                if not entries:
+                    del index[value]
+
+    ## Index all the captains of a cup again
+    def update_cup(self, cup_name, captains):
+        self.drop_cup(cup_name)
+        for captain in captains.values():
+            self.update(cup_name, captains, captain)
+
+    def drop_cup(self, cup_name):
+        for captain in [ c for c, (cup, _, _) in self.indexed.items() if cup == cup_name ]:
+            self.drop(captain)
+
+    ## Find a captain from its discord tag or key, in a given cup or the first
+    ## one that has it
+    def find(self, cups, discord=None, key=None, cup_name=None):
+        entries = self.by_discord.get(discord) if discord \
+                  else self.by_key.get(key)
+
+        for name, captain in (entries or {}).items():
+            if cup_name and name != cup_name:
+                continue
+
+            db = cups.get(name)
+            if db and db['captains'].get(captain.key) is captain \
+               and (not discord or captain.discord == discord):
+                return db, captain
+
+        return None, None
+
+### Matches of all the cups of a guild, by channel ID
+class MatchIndex:
+    def __init__(self):
+        self.by_channel = {}
+
+    def add(self, channel_id, cup_name, channel_name):
+        self.by_channel[channel_id] = (cup_name, channel_name)
+
+    def __contains__(self, channel_id):
+        return channel_id in self.by_channel
+
+    def drop_cup(self, cup_name):
+        for channel_id in [ i for i, (cup, _) in self.by_channel.items() if cup == cup_name ]:
+            del self.by_channel[channel_id]
+
+    ## Find the cup and match of a match channel
+    def find(self, cups, channel_id):
+        entry = self.by_channel.get(channel_id)
+        if not entry:
+            return None, None
+
+        cup_name, channel_name = entry
+        db = cups.get(cup_name)
+        match = db['matches'].get(channel_name) if db else None
+        if not match:
+            return None, None
+
+        return db, match
+
+### Cups running a captain hunt, by channel ID
+class HuntIndex:
+    def __init__(self):
+        self.by_channel = {}
+
+    def add(self, channel_id, cup_name):
+        self.drop_cup(cup_name)
+        self.by_channel[channel_id] = cup_name
+
+    def __contains__(self, channel_id):
+        return channel_id in self.by_channel
+
+    def drop_cup(self, cup_name):
+        for channel_id in [ i for i, cup in self.by_channel.items() if cup == cup_name ]:
+            del self.by_channel[channel_id]
+
+    ## Find the cup hunting captains in a channel
+    def find(self, cups, channel_id):
+        db = cups.get(self.by_channel.get(channel_id))
+        if not db \
+           or 'hunt' not in db \
+           or db['hunt'].get('channel_id') != channel_id:
+            return None
+
+        return db
+
+### Players of the cups of a guild (see !set_players), by nickname
+class PlayerIndex:
+    def __init__(self):
+        self.by_nick = {}
+
+        # Player list each cup was indexed from
+        self.indexed = {}
+
+    def update_cup(self, cup_name, players):
+        by_nick = {}
+        for player in players:
+            by_nick.setdefault(player['nickname'], player)
+
+        self.by_nick[cup_name] = by_nick
+        self.indexed[cup_name] = players
+
+    def drop_cup(self, cup_name):
+        self.by_nick.pop(cup_name, None)
+        self.indexed.pop(cup_name, None)
+
+    ## Find a player of a cup, indexing the players again if they were replaced
+    def find(self, cup_name, players, nickname):
+        if self.indexed.get(cup_name) is not players:
+            self.update_cup(cup_name, players)
+
+        return self.by_nick[cup_name].get(nickname)
+
+### Channels and roles of a guild by name, kept fresh by the gateway events
+class NameIndex:
+    def __init__(self, guild):
+        self.channels = {}
+        self.roles = {}
+
+        # Categories found by (lowercase) configured name
+        self.categories = {}
+
+        for channel in guild.channels:
+            self.add_channel(channel)
+        for role in guild.roles:
+            self.add_role(role)
+
+    def add_channel(self, channel):
+        self.channels.setdefault(channel.name, {})[channel.id] = channel
+        self.categories.clear()
+
+    def remove_channel(self, channel):
+        self.remove(self.channels, channel)
+        self.categories.clear()
+
+    def add_role(self, role):
+        self.roles.setdefault(role.name, {})[role.id] = role
+
+    def remove_role(self, role):
+        self.remove(self.roles, role)
+
+    def remove(self, index, obj):
+        entries = index.get(obj.name)
+        if entries and obj.id in entries:
+            del entries[obj.id]
+            if not entries:
+                del index[obj.name]
+
+    def get_channel(self, name):
+        entries = self.channels.get(name)
+        return next(iter(entries.values())) if entries else None
+
+    ## Same as discord.utils.get(guild.roles, ...), the lowest role wins
+    def get_role(self, name):
+        entries = self.roles.get(name)
+        return min(entries.values()) if entries else None
+
+    ## Find the last channel that has the category name in its own
+    def get_category(self, guild, cat_name):
+        cat_name = cat_name.lower()
+
+        if cat_name not in self.categories:
+            category = None
+            for ch in guild.channels:
+                if cat_name in ch.name.lower():
+                    category = ch
+            self.categories[cat_name] = category
+
+        return self.categories[cat_name]
+
+### Members of a guild by discord tag and ID, built once for an operation that
+### looks up many of them
+class MemberIndex:
+    def __init__(self, members):
+        self.by_tag = {}
+        self.by_id = {}
+
+        for member in members:
+            self.by_tag.setdefault(str(member), member)
+            self.by_id[member.id] = member
+
+    def __contains__(self, member):
+        return member.id in self.by_id
+
+    def get(self, discord):
+        return self.by_tag.get(discord)
+
+### Members holding each role of a guild, by role ID
+class RoleHolders:
+    def __init__(self, members):
+        self.holders = {}
+
+        for member in members:
+            self.add(member, member.roles)
+
+    def add(self, member, roles):
+        for role in roles:
+            self.holders.setdefault(role.id, set()).add(member.id)
+
+    def remove(self, member, roles):
+        for role in roles:
+            holders = self.holders.get(role.id)
+            if holders is not None:
+                holders.discard(member.id)
+                if not holders:
+                    del self.holders[role.id]
+
+    def update(self, before, after):
+        self.remove(after, [ r for r in before.roles if r not in after.roles ])
+        self.add(after, [ r for r in after.roles if r not in before.roles ])
+
+    def count(self, role):
+        return len(self.holders.get(role.id, ()))
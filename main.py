@@ -26,6 +26,8 @@ import asyncio
 import sys
 
 from rolekeeper import RoleKeeper
+from commands import CommandRegistry, Invocation, USAGE, ADMIN, REF, CAPTAIN, STREAMER
+from outbound import BROADCAST, BULK
 
 intents = discord.Intents.default()
 intents.guilds = True
@@ -50,6 +52,10 @@ async def on_ready():
 async def on_member_join(member):
     await rk.on_member_join(member)
 
+@client.event
+async def on_member_remove(member):
+    await rk.on_member_remove(member)
+
 @client.event
 async def on_member_update(before, after):
     await rk.on_member_update(before, after)
@@ -58,12 +64,37 @@ async def on_member_update(before, after):
 async def on_user_update(before, after):
     await rk.on_user_update(before, after)
 
+@client.event
+async def on_guild_channel_create(channel):
+    await rk.on_guild_channel_create(channel)
+
+@client.event
+async def on_guild_channel_delete(channel):
+    commands.drop_channel(channel)
+    await rk.on_guild_channel_delete(channel)
+
+@client.event
+async def on_guild_channel_update(before, after):
+    await rk.on_guild_channel_update(before, after)
+
+@client.event
+async def on_guild_role_create(role):
+    await rk.on_guild_role_create(role)
+
+@client.event
+async def on_guild_role_delete(role):
+    await rk.on_guild_role_delete(role)
+
+@client.event
+async def on_guild_role_update(before, after):
+    await rk.on_guild_role_update(before, after)
+
 client.cached_reaction_messages = {}
 async def get_message(guild_id, channel_id, message_id):
     if message_id not in client.cached_reaction_messages:
         guild = client.get_guild(guild_id)
         channel = guild.get_channel(channel_id)
-        message = await channel.fetch_message(message_id)
+        message = await rk.outbound.call('fetch', channel.id, channel.fetch_message, message_id)
         client.cached_reaction_messages[message_id] = message
     return client.cached_reaction_messages[message_id]
 
@@ -96,17 +127,21 @@ async def on_message(message):
     if not rk.check_guild(message.guild):
         return
 
-    is_admin = message.author.guild_permissions.manage_roles
-    is_ref = discord.utils.get(message.author.roles, name=rk.config['roles']['referee']['name']) or is_admin
-    is_captain_in_match = rk.is_captain_in_match(message.author, message.channel, is_admin or is_ref)
-    is_streamer = discord.utils.get(message.author.roles, name=rk.config['roles']['streamer']['name']) or is_ref
+    content = message.content.lstrip()
+    if len(content) <= 0:
+        return
 
-    if len(message.content) <= 0:
+    # Most messages are chat: skip them before resolving anything
+    if not content.startswith('!') \
+       and not rk.wants_message(message, content.startswith(('-', '+', '='))):
         return
 
+    # Load the guild DB if it is not yet
+    await rk.use_guild(message.guild)
+
     # Bypass command line when message is in a captain hunt channel
     _db, _error, _ = rk.find_cup_db(message.guild, hunt=message.channel)
-    if not _error and not is_ref:
+    if not _error and not rk.get_permissions(message.author)[1]:
         await rk.on_hunt_message(message, _db)
         return
 
@@ -114,6 +149,13 @@ async def on_message(message):
     args = message.content.replace(command, '', 1)
     command = command.lower()
 
+    # Only commands and pick&ban shortcuts are for us
+    if not command.startswith(('!', '-', '+', '=')):
+        return
+
+    is_admin, is_ref, is_streamer = rk.get_permissions(message.author)
+    is_captain_in_match = rk.is_captain_in_match(message.author, message.channel, is_admin or is_ref)
+
     # Special shortcut for pick&ban
     if is_captain_in_match and len(command) > 1:
         if command.startswith('-'):
@@ -126,504 +168,431 @@ async def on_message(message):
             args = command[1:] + ' ' + args
             command = '!side'
 
-    args = args.strip()
+    inv = Invocation(message, command, args, is_admin, is_ref, is_streamer, is_captain_in_match)
 
-    reuse_mode = RoleKeeper.REUSE_UNK
-    if args.endswith(' reuse'):
-        reuse_mode = RoleKeeper.REUSE_YES
-        args = args[:-6]
-    elif args.endswith(' new'):
-        reuse_mode = RoleKeeper.REUSE_NO
-        args = args[:-4]
-
-    parts = args.split()
+    # Unknown command, probably not for us
+    cmd = commands.get(command)
+    if not cmd or not inv.allowed(cmd.level):
+        return
 
     ret = False
     exception = None
 
     try:
-
-        if False:
-            pass
-
-    # ADMIN COMMANDS
-    #----------------
-
-        elif command == '!wipe_matches' and is_admin:
-            wipe_mode = None
-            if 'finished' in args:
-                wipe_mode = RoleKeeper.WIPE_FINISHED
-                args = args.replace('finished', '', 1)
-            elif 'rooms' in args:
-                wipe_mode = RoleKeeper.WIPE_ROOMS
-                args = args.replace('rooms', '', 1)
-            elif 'all' in args:
-                wipe_mode = RoleKeeper.WIPE_ALL
-                args = args.replace('all', '', 1)
-            else:
-                await rk.reply(message,
-                               'Not enough arguments:\n```!wipe_matches finished|rooms|all [cup]```')
-
-            if wipe_mode:
-                parts = args.split()
-                ret = await rk.wipe_matches(message,
-                                            parts[0] if len(parts) > 0 else '',
-                                            mode=wipe_mode)
-
-        elif command == '!wipe_messages' and is_admin:
-            if len(message.channel_mentions) < 1:
-                await rk.reply(message,
-                               'Not enough arguments:\n```!wipe_messages #channel```')
-            else:
-                ret = await rk.wipe_messages(message, message.channel_mentions[0])
-
-        elif command == '!announce' and is_admin:
-            ret = await rk.announce(args, message)
-
-        elif command == '!reconfig' and is_admin:
-            ret = await rk.reload_config(message)
-
-        elif command == '!broadcast' and is_admin:
-            if len(parts) > 0:
-                ret = await rk.broadcast_mode(message,
-                                              RoleKeeper.BCAST_ON \
-                                              if parts[0] == 'on' \
-                                              else RoleKeeper.BCAST_OFF)
-            else:
-                await rk.reply(message,
-                               'Too much or not enough arguments:\n```!broadcast on/off```')
-
-        elif command == '!members' and is_admin:
-            ret = await rk.export_members(message)
-
-        elif command == '!captains' and is_admin:
-            ret = await rk.export_captains(message,
-                                           parts[0] if len(parts) > 0 else '')
-
-        elif command == '!set_players' and is_admin:
-            if len(parts) > 0 and len(message.attachments) > 0:
-                ret = await rk.set_players(message,
-                                           parts[0],
-                                           message.attachments[0])
-            else:
-                await rk.reply(message,
-                               'Too much or not enough arguments:\n```!set_players name // PLAYERS_CID.csv```')
-        elif command == '!start_rewards' and is_admin:
-            if len(parts) > 1 and len(message.channel_mentions) > 0:
-                ret = await rk.start_rewards(message,
-                                             parts[0],
-                                             message.channel_mentions[0],
-                                             parts[2] if len(parts) > 2 else None,
-                                             message.attachments[0] if len(message.attachments) > 0 else None)
-            else:
-                await rk.reply(message,
-                               'Too much or not enough arguments:\n```!start_rewards name #channel pvp.gg // [PLAYERS_CID.csv]```')
-        elif command == '!export_rewards' and is_admin:
-            if len(parts) > 0:
-                ret = await rk.export_rewards(message,
-                                              parts[0],
-                                              message.attachments[0] if len(message.attachments) > 0 else None)
-            else:
-                await rk.reply(message,
-                               'Too much or not enough arguments:\n```!export_rewards name // [PLAYERS_CID.csv]```')
-        elif command == '!stop_rewards' and is_admin:
-            ret = await rk.stop_rewards(message,
-                                        parts[0] if len(parts) > 0 else '')
-
-        elif command == '!stats' and is_admin:
-            ret = await rk.export_stats(message,
-                                        parts[0] if len(parts) > 0 else '')
-
-        elif command == '!start_cup' and is_admin:
-            if len(parts) > 0:
-                ret = await rk.start_cup(message,
-                                         parts[0],
-                                         message.attachments[0] if len(message.attachments) > 0 else None,
-                                         selected_maps_key=parts[1] if len(parts) > 1 else None)
-            else:
-                await rk.reply(message,
-                               'Too much or not enough arguments:\n```!start_cup name [maps_key] [// TEAMS.csv]```')
-
-        elif command == '!check_cup' and is_admin:
-            if len(parts) > 0:
-                ret = await rk.check_cup(message,
-                                         parts[0],
-                                         message.attachments[0] if len(message.attachments) > 0 else None,
-                                         pvpgg_link = parts[1] if len(parts) > 1 else None)
-            else:
-                await rk.reply(message,
-                               'Too much or not enough arguments:\n```!check_cup name [pvp.gg] [// TEAMS.csv]```')
-
-        elif command == '!update_cup' and is_admin:
-            if len(parts) > 0 and len(message.attachments) > 0:
-                ret = await rk.update_cup(message,
-                                         parts[0],
-                                         message.attachments[0])
-            else:
-                await rk.reply(message,
-                               'Too much or not enough arguments:\n```!update_cup name // TEAMS.csv```')
-
-        elif command == '!stop_cup' and is_admin:
-            if len(parts) > 0:
-                ret = await rk.stop_cup(message,
-                                        parts[0])
-            else:
-                await rk.reply(message,
-                               'Too much or not enough arguments:\n```!stop_cup name```')
-
-        elif command == '!cups' and is_admin:
-            ret = await rk.list_cups(message)
-
-        elif command == '!start_hunt' and is_admin:
-            channel = message.channel_mentions[0] if len(message.channel_mentions) > 0 else message.channel
-            if len(parts) > 0:
-                ret = await rk.start_hunt(message,
-                                          parts[0],
-                                          channel)
-            else:
-                await rk.reply(message,
-                               'Too much or not enough arguments:\n```!start_hunt cup [#channel]```')
-
-        elif command == '!stop_hunt' and is_admin:
-            if len(parts) > 0:
-                ret = await rk.stop_hunt(message,
-                                         parts[0])
-            else:
-                await rk.reply(message,
-                               'Too much or not enough arguments:\n```!stop_hunt cup```')
-
-        # REF COMMANDS
-        #--------------
-
-        elif command == '!add_group' and is_ref:
-            if len(parts) >= 1:
-                ret = await rk.add_group(message,
-                                         message.guild,
-                                         parts[0],
-                                         parts[1] if len(parts) >= 2 else '')
-            else:
-                await rk.reply(message,
-                               'Too much or not enough arguments:\n```!add_group group [cup]```')
-
-        elif command == '!remove_group' and is_ref:
-            if len(parts) >= 1:
-                ret = await rk.remove_group(message,
-                                            message.guild,
-                                            parts[0],
-                                            parts[1] if len(parts) >= 2 else '')
-            else:
-                await rk.reply(message,
-                               'Too much or not enough arguments:\n```!remove_group group [cup]```')
-
-        elif command == '!add_captain' and is_ref:
-            member = message.mentions[0] if len(message.mentions) >= 1 \
-                     else message.guild.get_member(int(parts[0])) if len(parts) >= 4 and parts[0].isdigit() \
-                          else None
-
-            if member:
-                ret = await rk.add_captain(message,
-                                           message.guild,
-                                           member,
-                                           parts[1],
-                                           parts[2],
-                                           parts[3] if parts[3] != '-' else None,
-                                           parts[4] if len(parts) > 4 else '')
-            else:
-                await rk.reply(message,
-                               'Too much or not enough arguments:\n```!add_captain @xxx team nick group|- [cup]```')
-
-        elif command == '!update_captain' and is_ref:
-            member = message.mentions[0] if len(message.mentions) >= 1 \
-                     else message.guild.get_member(int(parts[0])) if len(parts) >= 2 and parts[0].isdigit() \
-                          else None
-
-            if member:
-                ret = await rk.update_captain(message,
-                                              message.guild,
-                                              member,
-                                              parts[1],
-                                              parts[2] if len(parts) > 2 else '')
-            else:
-                await rk.reply(message,
-                               'Too much or not enough arguments:\n```!update_captain @xxx nickname [cup]```')
-
-        elif command == '!update_team' and is_ref:
-            if len(parts) >= 2:
-                ret = await rk.update_team(message,
-                                           message.guild,
-                                           parts[0],
-                                           parts[1],
-                                           parts[2] if len(parts) > 2 else '')
-            else:
-                await rk.reply(message,
-                               'Too much or not enough arguments:\n```!update_team team_name new_name [cup]```')
-
-        elif command == '!remove_captain' and is_ref:
-            member = message.mentions[0] if len(message.mentions) >= 1 \
-                     else message.guild.get_member(int(parts[0])) if len(parts) >= 1 and parts[0].isdigit() \
-                          else None
-
-            if member:
-                ret = await rk.remove_captain(message,
-                                              message.guild,
-                                              member,
-                                              parts[1] if len(parts) > 1 else '')
-            else:
-                await rk.reply(message,
-                               'Too much or not enough arguments:\n```!remove_captain @xxx [cup]```')
-
-        elif command == '!check_captain' and is_ref:
-            member = message.mentions[0] if len(message.mentions) >= 1 \
-                     else message.guild.get_member(int(parts[0])) if len(parts) >= 1 and parts[0].isdigit() \
-                          else None
-
-            if member:
-                ret = await rk.check_captain(message,
-                                              message.guild,
-                                              member,
-                                              parts[1] if len(parts) > 1 else '')
-            else:
-                await rk.reply(message,
-                               'Too much or not enough arguments:\n```!check_captain @xxx [cup]```')
-
-        elif is_ref and (command == '!bo1' or command == '!bo2' or command == '!bo3' or command == '!bo5'):
-            mode = RoleKeeper.MATCH_BO1
-            if command == '!bo2':
-                mode = RoleKeeper.MATCH_BO2
-            elif command == '!bo3':
-                mode = RoleKeeper.MATCH_BO3
-            elif command == '!bo5':
-                mode = RoleKeeper.MATCH_BO5
-
-            cat_id = parts[2][1:] \
-                     if len(parts) > 2 and parts[2].startswith('>')\
-                        else None
-            cup_name = parts[3] \
-                       if len(parts) > 3 \
-                          else parts[2] \
-                               if len(parts) > 2 and not parts[2].startswith('>') \
-                                  else ''
-
-            if len(message.role_mentions) == 2:
-                ret, _ = await rk.matchup_role(message,
-                                               message.guild,
-                                               message.role_mentions[0],
-                                               message.role_mentions[1],
-                                               cat_id,
-                                               cup_name,
-                                               mode=mode,
-                                               reuse=reuse_mode)
-            elif len(message.mentions) == 2:
-                ret, _ = await rk.matchup_cpt (message,
-                                               message.guild,
-                                               message.mentions[0],
-                                               message.mentions[1],
-                                               cat_id,
-                                               cup_name,
-                                               mode=mode,
-                                               reuse=reuse_mode)
-            elif len(parts) >= 2:
-                ret, _ = await rk.matchup_team(message,
-                                               message.guild,
-                                               parts[0],
-                                               parts[1],
-                                               cat_id,
-                                               cup_name,
-                                               mode=mode,
-                                               reuse=reuse_mode)
-            else:
-                await rk.reply(message,
-                               'Too much or not enough arguments:\n'
-                               '```{command} @xxx @yyy [>category] [cup] [new/reuse]```'\
-                               .format(command=command))
-
-
-
-        elif is_ref and command == '!ffa':
-            cat_id = parts[-1][1:] \
-                     if len(parts) > 2 and parts[-1].startswith('>') \
-                        else parts[-2][1:] \
-                             if len(parts) > 3 and parts[-2].startswith('>') \
-                                else None
-
-            cup_name = parts[-1][1:] \
-                       if len(parts) > 3 and parts[-1].startswith('?') \
-                          else parts[-2][1:] \
-                               if len(parts) > 2 and parts[-2].startswith('?') \
-                                  else ''
-
-            round=parts[0] if len(parts) > 0 else None
-            match=parts[1] if len(parts) > 1 else None
-
-            if round and match and len(message.mentions) > 0:
-                ret, _ = await rk.matchup_ffa (message,
-                                               message.guild,
-                                               round,
-                                               match,
-                                               cat_id,
-                                               cup_name,
-                                               players=message.mentions,
-                                               reuse=reuse_mode)
-            elif round and match and len(message.attachments) > 0:
-                ret, _ = await rk.matchup_ffa (message,
-                                               message.guild,
-                                               round,
-                                               match,
-                                               cat_id,
-                                               cup_name,
-                                               players_csv=message.attachments[0],
-                                               reuse=reuse_mode)
-            elif round and match and len(parts) > 2:
-                end = -2 if len(cup_name) > 0 and cat_id else -1 if len(cup_name) > 0 or cat_id else 0
-                names = [ p.replace(',', '') for p in (parts[2:end] if end < 0 else parts[2:]) ]
-                ret, _ = await rk.matchup_ffa (message,
-                                               message.guild,
-                                               round,
-                                               match,
-                                               cat_id,
-                                               cup_name,
-                                               team_names=names,
-                                               reuse=reuse_mode)
-            else:
-                await rk.reply(message,
-                               'Too much or not enough arguments:\n'
-                               '```!ffa round match [@member1 @member2 ...|player1, player2, ...] [>category] [?cup] [new/reuse] [// Players.csv]```')
-
-
-
-        elif command == '!undo' and is_ref:
-            ret = await rk.undo_map(message)
-
-        elif command == '!close' and is_ref:
-            ret = await rk.close_match(message)
-
-        elif command == '!say' and is_ref:
-            if len(parts) > 1 or (len(parts) == 1 and len(message.attachments) > 0):
-                channel_id = parts[0]
-                if channel_id.startswith('<'):
-                    channel_id = channel_id[2:-1]
-                    channel = message.guild.get_channel(int(channel_id))
-                else:
-                    channel = discord.utils.get(message.guild.channels, name=channel_id)
-
-                if channel:
-                    msg = args.replace(parts[0], '', 1)
-                    try:
-                        if len(message.attachments) > 0:
-                            for attachment in message.attachments:
-                                attach = await rk.fetch_text_attachment(attachment)
-                                if attach:
-                                    await rk.send(channel, attach)
-                        else:
-                            await rk.send(channel, msg)
-
-                        ret = True
-                    except:
-                        await rk.reply(message,
-                                       'I do not see channel `#{}`'.format(channel.name))
-                else:
-                    await rk.reply(message,
-                                   'No channel named `#{}`'.format(channel_id))
-            else:
-                await rk.reply(message,
-                               'Not enough arguments:\n```!say #channel message...```')
-
-        elif command == '!sync_cup' and is_ref:
-            if len(parts) >= 2:
-                ret = await rk.sync_cup(message,
-                                        parts[0],
-                                        parts[1],
-                                        parts[2][1:] \
-                                        if len(parts) > 2 and parts[2].startswith('>')\
-                                        else None)
-            else:
-                await rk.reply(message,
-                               'Too much or not enough arguments:\n```!sync_cup cup bracket_url [>category]```')
-
-        elif command == '!desync_cup' and is_ref:
-            if len(parts) >= 1:
-                ret = await rk.desync_cup(message,
-                                          parts[0])
-            else:
-                await rk.reply(message,
-                               'Too much or not enough arguments:\n```!desync_cup cup```')
-
-        # CAPTAIN COMMANDS
-        #-------------------
-
-
-        elif command == '!ban' and is_captain_in_match:
-            ret = await rk.ban_map(message,
-                                   parts[0] if len(parts) > 0 else '',
-                                   force=is_ref)
-
-        elif command == '!pick' and is_captain_in_match:
-            ret = await rk.pick_map(message,
-                                    parts[0] if len(parts) > 0 else '',
-                                    force=is_ref)
-
-        elif command == '!side' and is_captain_in_match:
-            ret = await rk.choose_side(message,
-                                       parts[0] if len(parts) > 0 else '',
-                                       force=is_ref)
-
-        elif command == '!attack' and is_captain_in_match:
-            ret = await rk.choose_side(message,
-                                       'attack',
-                                       force=is_ref)
-
-        elif command == '!defense' and is_captain_in_match:
-            ret = await rk.choose_side(message,
-                                       'defense',
-                                       force=is_ref)
-
-        # STREAMER COMMANDS
-        #-------------------
-
-        elif command == '!stream' and is_streamer:
-            channel_name = message.channel_mentions[0].name if len(message.channel_mentions) > 0 \
-                      else parts[0] if len(parts) > 0 \
-                           else None
-
-            if channel_name:
-                ret = await rk.stream_match(message,
-                                            channel_name,
-                                            message.mentions[0] if len(message.mentions) > 0 else None)
-            else:
-                await rk.reply(message,
-                               'Not enough arguments:\n```!stream channel_id [@streamer]```')
-
-        elif command == '!unstream' and is_streamer:
-            channel_name = message.channel_mentions[0].name if len(message.channel_mentions) > 0 \
-                      else parts[0] if len(parts) > 0 \
-                           else None
-
-            if channel_name:
-                ret = await rk.unstream_match(message,
-                                              channel_name,
-                                              message.mentions[0] if len(message.mentions) > 0 else None)
-            else:
-                await rk.reply(message,
-                               'Not enough arguments:\n```!unstream channel_id [@streamer]```')
-
-
-        # Unknown command, probably not for us:
-        #-------------------------------------
-        else:
-            return
+        ret = await commands.dispatch(cmd, inv)
+        if ret is USAGE:
+            ret = False
+            await rk.reply(message,
+                           'Too much or not enough arguments:\n```{}```'\
+                           .format(commands.usage(cmd, inv)))
 
     except Exception as e:
         ret = False
         exception = e
 
     try:
-        await message.add_reaction('\N{WHITE HEAVY CHECK MARK}' if ret else '\N{NO ENTRY}')
+        await rk.outbound.call('reaction', message.channel.id, message.add_reaction, '\N{WHITE HEAVY CHECK MARK}' if ret else '\N{NO ENTRY}')
     except:
         pass
 
     if exception:
         raise exception
 
+commands = CommandRegistry()
+
+# ADMIN COMMANDS
+#----------------
+
+@commands.command('!wipe_matches', ADMIN, priority=BULK, usage='!wipe_matches finished|rooms|all [cup]')
+async def wipe_matches(inv):
+    for name, wipe_mode in (('finished', RoleKeeper.WIPE_FINISHED),
+                            ('rooms', RoleKeeper.WIPE_ROOMS),
+                            ('all', RoleKeeper.WIPE_ALL)):
+        if name in inv.args:
+            parts = inv.args.replace(name, '', 1).split()
+            return await rk.wipe_matches(inv.message,
+                                         parts[0] if len(parts) > 0 else '',
+                                         mode=wipe_mode)
+
+    return USAGE
+
+@commands.command('!wipe_messages', ADMIN, priority=BULK, usage='!wipe_messages #channel')
+async def wipe_messages(inv):
+    if len(inv.message.channel_mentions) < 1:
+        return USAGE
+
+    return await rk.wipe_messages(inv.message, inv.message.channel_mentions[0])
+
+@commands.command('!announce', ADMIN, priority=BROADCAST)
+async def announce(inv):
+    return await rk.announce(inv.args, inv.message)
+
+@commands.command('!reconfig', ADMIN)
+async def reconfig(inv):
+    return await rk.reload_config(inv.message)
+
+@commands.command('!broadcast', ADMIN, min_parts=1, usage='!broadcast on/off')
+async def broadcast(inv):
+    return await rk.broadcast_mode(inv.message,
+                                   RoleKeeper.BCAST_ON \
+                                   if inv.parts[0] == 'on' \
+                                   else RoleKeeper.BCAST_OFF)
+
+@commands.command('!members', ADMIN)
+async def members(inv):
+    return await rk.export_members(inv.message)
+
+@commands.command('!captains', ADMIN)
+async def captains(inv):
+    return await rk.export_captains(inv.message, inv.part(0))
+
+@commands.command('!set_players', ADMIN, min_parts=1,
+                  usage='!set_players name // PLAYERS_CID.csv')
+async def set_players(inv):
+    if not inv.attachment():
+        return USAGE
+
+    return await rk.set_players(inv.message, inv.parts[0], inv.attachment())
+
+@commands.command('!start_rewards', ADMIN, min_parts=2, priority=BULK,
+                  usage='!start_rewards name #channel pvp.gg // [PLAYERS_CID.csv]')
+async def start_rewards(inv):
+    if len(inv.message.channel_mentions) <= 0:
+        return USAGE
+
+    return await rk.start_rewards(inv.message,
+                                  inv.parts[0],
+                                  inv.message.channel_mentions[0],
+                                  inv.part(2, None),
+                                  inv.attachment())
+
+@commands.command('!export_rewards', ADMIN, min_parts=1,
+                  usage='!export_rewards name // [PLAYERS_CID.csv]')
+async def export_rewards(inv):
+    return await rk.export_rewards(inv.message, inv.parts[0], inv.attachment())
+
+@commands.command('!stop_rewards', ADMIN)
+async def stop_rewards(inv):
+    return await rk.stop_rewards(inv.message, inv.part(0))
+
+@commands.command('!stats', ADMIN)
+async def stats(inv):
+    return await rk.export_stats(inv.message, inv.part(0))
+
+@commands.command('!command_stats', ADMIN)
+async def command_stats(inv):
+    lines = [ '{}: {}'.format(name, stats)
+              for name, stats in sorted(commands.stats.items(),
+                                        key=lambda s: -s[1].total)
+              if stats.count > 0 ]
+
+    # Match rooms where commands had to wait the most
+    queues = sorted(commands.channels.values(), key=lambda q: -q.total_wait)[:10]
+    if queues:
+        lines.append('')
+        lines.extend([ '#{}: {}'.format(queue.name, queue) for queue in queues ])
+
+    await rk.reply(inv.message, '```{}```'.format('\n'.join(lines) if lines else 'No command used yet'))
+    return True
+
+@commands.command('!start_cup', ADMIN, min_parts=1, priority=BULK,
+                  usage='!start_cup name [maps_key] [// TEAMS.csv]')
+async def start_cup(inv):
+    return await rk.start_cup(inv.message,
+                              inv.parts[0],
+                              inv.attachment(),
+                              selected_maps_key=inv.part(1, None))
+
+@commands.command('!check_cup', ADMIN, min_parts=1, priority=BULK,
+                  usage='!check_cup name [pvp.gg] [// TEAMS.csv]')
+async def check_cup(inv):
+    return await rk.check_cup(inv.message,
+                              inv.parts[0],
+                              inv.attachment(),
+                              pvpgg_link=inv.part(1, None))
+
+@commands.command('!update_cup', ADMIN, min_parts=1, priority=BULK,
+                  usage='!update_cup name // TEAMS.csv')
+async def update_cup(inv):
+    if not inv.attachment():
+        return USAGE
+
+    return await rk.update_cup(inv.message, inv.parts[0], inv.attachment())
+
+@commands.command('!stop_cup', ADMIN, min_parts=1, priority=BULK, usage='!stop_cup name')
+async def stop_cup(inv):
+    return await rk.stop_cup(inv.message, inv.parts[0])
+
+@commands.command('!cups', ADMIN)
+async def cups(inv):
+    return await rk.list_cups(inv.message)
+
+@commands.command('!start_hunt', ADMIN, min_parts=1, usage='!start_hunt cup [#channel]')
+async def start_hunt(inv):
+    channel = inv.message.channel_mentions[0] if len(inv.message.channel_mentions) > 0 \
+              else inv.message.channel
+
+    return await rk.start_hunt(inv.message, inv.parts[0], channel)
+
+@commands.command('!stop_hunt', ADMIN, min_parts=1, usage='!stop_hunt cup')
+async def stop_hunt(inv):
+    return await rk.stop_hunt(inv.message, inv.parts[0])
+
+# REF COMMANDS
+#--------------
+
+@commands.command('!add_group', REF, min_parts=1, usage='!add_group group [cup]')
+async def add_group(inv):
+    return await rk.add_group(inv.message, inv.message.guild, inv.parts[0], inv.part(1))
+
+@commands.command('!remove_group', REF, min_parts=1, usage='!remove_group group [cup]')
+async def remove_group(inv):
+    return await rk.remove_group(inv.message, inv.message.guild, inv.parts[0], inv.part(1))
+
+## Member given as a mention or as an ID in the first argument
+def mentioned_member(inv, min_parts):
+    if len(inv.message.mentions) >= 1:
+        return inv.message.mentions[0]
+    if len(inv.parts) >= min_parts and inv.parts[0].isdigit():
+        return inv.message.guild.get_member(int(inv.parts[0]))
+    return None
+
+@commands.command('!add_captain', REF, usage='!add_captain @xxx team nick group|- [cup]')
+async def add_captain(inv):
+    member = mentioned_member(inv, 4)
+    if not member:
+        return USAGE
+
+    return await rk.add_captain(inv.message,
+                                inv.message.guild,
+                                member,
+                                inv.parts[1],
+                                inv.parts[2],
+                                inv.parts[3] if inv.parts[3] != '-' else None,
+                                inv.part(4))
+
+@commands.command('!update_captain', REF, usage='!update_captain @xxx nickname [cup]')
+async def update_captain(inv):
+    member = mentioned_member(inv, 2)
+    if not member:
+        return USAGE
+
+    return await rk.update_captain(inv.message,
+                                   inv.message.guild,
+                                   member,
+                                   inv.parts[1],
+                                   inv.part(2))
+
+@commands.command('!update_team', REF, min_parts=2, usage='!update_team team_name new_name [cup]')
+async def update_team(inv):
+    return await rk.update_team(inv.message,
+                                inv.message.guild,
+                                inv.parts[0],
+                                inv.parts[1],
+                                inv.part(2))
+
+@commands.command('!remove_captain', REF, usage='!remove_captain @xxx [cup]')
+async def remove_captain(inv):
+    member = mentioned_member(inv, 1)
+    if not member:
+        return USAGE
+
+    return await rk.remove_captain(inv.message, inv.message.guild, member, inv.part(1))
+
+@commands.command('!check_captain', REF, usage='!check_captain @xxx [cup]')
+async def check_captain(inv):
+    member = mentioned_member(inv, 1)
+    if not member:
+        return USAGE
+
+    return await rk.check_captain(inv.message, inv.message.guild, member, inv.part(1))
+
+@commands.command('!bo1', REF, aliases=('!bo2', '!bo3', '!bo5'), reuse=True, tokens=True,
+                  usage='{command} @xxx @yyy [>category] [cup] [new/reuse]')
+async def bo(inv):
+    mode = { '!bo1': RoleKeeper.MATCH_BO1,
+             '!bo2': RoleKeeper.MATCH_BO2,
+             '!bo3': RoleKeeper.MATCH_BO3,
+             '!bo5': RoleKeeper.MATCH_BO5 }[inv.command]
+
+    cup_name = inv.cup if inv.cup is not None else inv.part(2)
+
+    if len(inv.message.role_mentions) == 2:
+        ret, _ = await rk.matchup_role(inv.message,
+                                       inv.message.guild,
+                                       inv.message.role_mentions[0],
+                                       inv.message.role_mentions[1],
+                                       inv.category,
+                                       cup_name,
+                                       mode=mode,
+                                       reuse=inv.reuse)
+    elif len(inv.message.mentions) == 2:
+        ret, _ = await rk.matchup_cpt (inv.message,
+                                       inv.message.guild,
+                                       inv.message.mentions[0],
+                                       inv.message.mentions[1],
+                                       inv.category,
+                                       cup_name,
+                                       mode=mode,
+                                       reuse=inv.reuse)
+    elif len(inv.parts) >= 2:
+        ret, _ = await rk.matchup_team(inv.message,
+                                       inv.message.guild,
+                                       inv.parts[0],
+                                       inv.parts[1],
+                                       inv.category,
+                                       cup_name,
+                                       mode=mode,
+                                       reuse=inv.reuse)
+    else:
+        return USAGE
+
+    return ret
+
+@commands.command('!ffa', REF, min_parts=2, reuse=True, tokens=True,
+                  usage='!ffa round match [@member1 @member2 ...|player1, player2, ...] [>category] [?cup] [new/reuse] [// Players.csv]')
+async def ffa(inv):
+    round = inv.parts[0]
+    match = inv.parts[1]
+    cup_name = inv.cup or ''
+
+    if len(inv.message.mentions) > 0:
+        ret, _ = await rk.matchup_ffa (inv.message,
+                                       inv.message.guild,
+                                       round,
+                                       match,
+                                       inv.category,
+                                       cup_name,
+                                       players=inv.message.mentions,
+                                       reuse=inv.reuse)
+    elif inv.attachment():
+        ret, _ = await rk.matchup_ffa (inv.message,
+                                       inv.message.guild,
+                                       round,
+                                       match,
+                                       inv.category,
+                                       cup_name,
+                                       players_csv=inv.attachment(),
+                                       reuse=inv.reuse)
+    elif len(inv.parts) > 2:
+        names = [ p.replace(',', '') for p in inv.parts[2:] ]
+        ret, _ = await rk.matchup_ffa (inv.message,
+                                       inv.message.guild,
+                                       round,
+                                       match,
+                                       inv.category,
+                                       cup_name,
+                                       team_names=names,
+                                       reuse=inv.reuse)
+    else:
+        return USAGE
+
+    return ret
+
+@commands.command('!undo', REF, serial=True)
+async def undo(inv):
+    return await rk.undo_map(inv.message)
+
+@commands.command('!close', REF, serial=True)
+async def close(inv):
+    return await rk.close_match(inv.message)
+
+@commands.command('!say', REF, min_parts=1, priority=BROADCAST, usage='!say #channel message...')
+async def say(inv):
+    message = inv.message
+    parts = inv.parts
+
+    if len(parts) == 1 and len(message.attachments) == 0:
+        return USAGE
+
+    channel_id = parts[0]
+    if channel_id.startswith('<'):
+        channel_id = channel_id[2:-1]
+        channel = message.guild.get_channel(int(channel_id))
+    else:
+        channel = rk.get_channel(message.guild, channel_id)
+
+    if not channel:
+        await rk.reply(message,
+                       'No channel named `#{}`'.format(channel_id))
+        return False
+
+    msg = inv.args.replace(parts[0], '', 1)
+    try:
+        if len(message.attachments) > 0:
+            for attachment in message.attachments:
+                attach = await rk.fetch_text_attachment(attachment)
+                if attach:
+                    await rk.send(channel, attach)
+        else:
+            await rk.send(channel, msg)
+
+        return True
+    except:
+        await rk.reply(message,
+                       'I do not see channel `#{}`'.format(channel.name))
+        return False
+
+@commands.command('!sync_cup', REF, min_parts=2, tokens=True,
+                  usage='!sync_cup cup bracket_url [>category]')
+async def sync_cup(inv):
+    return await rk.sync_cup(inv.message, inv.parts[0], inv.parts[1], inv.category)
+
+@commands.command('!desync_cup', REF, min_parts=1, usage='!desync_cup cup')
+async def desync_cup(inv):
+    return await rk.desync_cup(inv.message, inv.parts[0])
+
+# CAPTAIN COMMANDS
+#-------------------
+
+@commands.command('!ban', CAPTAIN, serial=True)
+async def ban(inv):
+    return await rk.ban_map(inv.message, inv.part(0), force=inv.is_ref)
+
+@commands.command('!pick', CAPTAIN, serial=True)
+async def pick(inv):
+    return await rk.pick_map(inv.message, inv.part(0), force=inv.is_ref)
+
+@commands.command('!side', CAPTAIN, serial=True)
+async def side(inv):
+    return await rk.choose_side(inv.message, inv.part(0), force=inv.is_ref)
+
+@commands.command('!attack', CAPTAIN, serial=True)
+async def attack(inv):
+    return await rk.choose_side(inv.message, 'attack', force=inv.is_ref)
+
+@commands.command('!defense', CAPTAIN, serial=True)
+async def defense(inv):
+    return await rk.choose_side(inv.message, 'defense', force=inv.is_ref)
+
+# STREAMER COMMANDS
+#-------------------
+
+## Match channel given as a mention or as a name in the first argument
+def mentioned_channel_name(inv):
+    return inv.message.channel_mentions[0].name if len(inv.message.channel_mentions) > 0 \
+        else inv.part(0, None)
+
+@commands.command('!stream', STREAMER, usage='!stream channel_id [@streamer]')
+async def stream(inv):
+    channel_name = mentioned_channel_name(inv)
+    if not channel_name:
+        return USAGE
+
+    return await rk.stream_match(inv.message,
+                                 channel_name,
+                                 inv.message.mentions[0] if len(inv.message.mentions) > 0 else None)
+
+@commands.command('!unstream', STREAMER, usage='!unstream channel_id [@streamer]')
+async def unstream(inv):
+    channel_name = mentioned_channel_name(inv)
+    if not channel_name:
+        return USAGE
+
+    return await rk.unstream_match(inv.message,
+                                   channel_name,
+                                   inv.message.mentions[0] if len(inv.message.mentions) > 0 else None)
+
 if __name__ == '__main__':
 
     config_file = 'config.json'
@@ -26,8 +26,27 @@ from difflib import SequenceMatcher
 from inputs import *
 from locale_s import tr
 from carousel import Carousel
+from tracked import Tracked
+
+# Map pools shared by all the matches using them
+map_pools = {}
+
+def shared_maps(maps):
+    maps = tuple(maps)
+    return map_pools.setdefault(maps, maps)
+
+# Attributes set by the constructor of each kind of match (see Match.layout)
+layouts = {}
+
+# Attributes not in the versioned state of an object, saved as they are
+def extra_state(obj, fields):
+    return { k: v for k, v in obj.__dict__.items() if k not in fields and k != '_touch' }
+
+class MatchFFA(Tracked):
+    # Version of the state saved by __getstate__
+    STATE_VERSION = 1
+    STATE_FIELDS = ( 'round', 'match', 'players', 'mode', 'mode_title', 'mode_intro', 'url' )
 
-class MatchFFA:
     def __init__(self, round, match, players):
         self.round = round
         self.match = match
@@ -39,6 +58,27 @@ class MatchFFA:
 
         self.url = None
 
+    ## Override pickle serialization
+    def __getstate__(self):
+        return (self.STATE_VERSION,
+                self.round,
+                self.match,
+                tuple(self.players),
+                self.url,
+                extra_state(self, self.STATE_FIELDS))
+
+    def __setstate__(self, state):
+        # Saved by an older version
+        if isinstance(state, dict):
+            self.__dict__.update(state)
+            return
+
+        _, round, match, players, url, extra = state
+
+        self.__init__(round, match, list(players))
+        self.url = url
+        self.__dict__.update(extra)
+
     def is_in_match(self, member):
         for player in self.players:
             if player.member and player.member.id == member.id:
@@ -79,13 +119,30 @@ class MatchFFA:
     async def close_match(self, handle):
         return False
 
-class Match:
+class Match(Tracked):
+    UNTRACKED = ( 'carousel', 'bot' )
+
+    # Version of the state saved by __getstate__
+    STATE_VERSION = 1
+    STATE_FIELDS = ( 'teams', 'teamA', 'teamB', 'maps', 'banned_maps', 'picked_maps',
+                     'picked_sides', 'turn', 'bot', 'mode', 'mode_title', 'mode_intro',
+                     'sequence', 'sides', 'status_handle', 'turn_handle', 'force_done',
+                     'auto_done', 'deleted', 'last_is_a_pick', 'last_picked', 'url',
+                     'teamA_icon', 'teamB_icon', 'carousel', 'streamed' )
+
+    # Flags of the saved state
+    FLAGS = ( 'force_done', 'auto_done', 'deleted', 'last_picked', 'streamed' )
+
+    sides = { 'defends': [ 'defends', 'defend', 'defense', 'defence', 'warface', 'wf', 'def', 'd' ],
+              'attacks' : [ 'attacks', 'attack', 'attacking', 'blackwood', 'offense', 'bw', 'att', 'a' ] }
+    side_ids = tuple(sides.keys())
+
     def __init__(self, teamA, teamB, maps, bot=None):
         self.teams = [ teamA, teamB ]
         self.teamA = teamA
         self.teamB = teamB
 
-        self.maps = maps
+        self.maps = shared_maps(maps)
         self.banned_maps = []
         self.picked_maps = []
         self.picked_sides = []
@@ -102,9 +159,6 @@ class Match:
             a = 'side' if i >= len(self.maps) - 1 else 'ban'
             self.sequence.append( (t, a) )
 
-        self.sides = { 'defends': [ 'defends', 'defend', 'defense', 'defence', 'warface', 'wf', 'def', 'd' ],
-                       'attacks' : [ 'attacks', 'attack', 'attacking', 'blackwood', 'offense', 'bw', 'att', 'a' ] }
-
         self.status_handle = None
         self.turn_handle = None
         self.force_done = False
@@ -122,24 +176,75 @@ class Match:
         self.streamed = False
 
     ## Override pickle serialization
+    ##
+    ## The mode, texts and ban/pick sequence are rebuilt from the class, maps
+    ## and sides are saved as indices.
     def __getstate__(self):
-        state = dict(self.__dict__)
-
-        # We cannot serialize this object, thus, remove it
-        state['carousel'] = None
-        state['bot'] = None
-
-        return state
+        return (self.STATE_VERSION,
+                self.teamA,
+                self.teamB,
+                self.maps,
+                bytes(self.maps.index(m) for m in self.banned_maps),
+                bytes(self.maps.index(m) for m in self.picked_maps),
+                bytes(self.side_ids.index(s) for s in self.picked_sides),
+                self.turn,
+                sum(1 << i for i, flag in enumerate(self.FLAGS) if getattr(self, flag)),
+                self.status_handle,
+                self.turn_handle,
+                self.url,
+                self.teamA_icon,
+                self.teamB_icon,
+                extra_state(self, self.STATE_FIELDS))
+
+    def __setstate__(self, state):
+        # Saved by an older version
+        if isinstance(state, dict):
+            state['maps'] = shared_maps(state['maps'])
+            self.__dict__.update(state)
+            return
+
+        _, teamA, teamB, maps, banned, picked, sides, turn, flags, \
+            status_handle, turn_handle, url, teamA_icon, teamB_icon, extra = state
+
+        teams = [ teamA, teamB ]
+        maps = shared_maps(maps)
+
+        self.__dict__.update(self.layout(maps))
+        self.__dict__.update({
+            'teams': teams,
+            'teamA': teamA,
+            'teamB': teamB,
+            'sequence': [ (teams[t], a) for t, a in self.sequence ],
+            'banned_maps': [ maps[i] for i in banned ],
+            'picked_maps': [ maps[i] for i in picked ],
+            'picked_sides': [ self.side_ids[i] for i in sides ],
+            'turn': turn,
+            'status_handle': status_handle,
+            'turn_handle': turn_handle,
+            'url': url,
+            'teamA_icon': teamA_icon,
+            'teamB_icon': teamB_icon,
+        })
+        self.__dict__.update({ flag: bool(flags & (1 << i)) for i, flag in enumerate(self.FLAGS) })
+        self.__dict__.update(extra)
+
+    ## Attributes set by the constructor for a map pool, with teams 0 and 1
+    ## in the sequence
+    @classmethod
+    def layout(cls, maps):
+        key = (cls, maps)
+        if key not in layouts:
+            layouts[key] = dict(cls(0, 1, maps).__dict__)
+
+        return layouts[key]
 
     async def resume(self, guild, bot, db):
+        # Messages are fetched when the match is used again
         if hasattr(self, 'status_handle') and self.status_handle:
-            await self.status_handle.resume(guild, bot)
+            self.status_handle.defer(guild, bot)
 
         if hasattr(self, 'turn_handle') and self.turn_handle:
-            await self.turn_handle.resume(guild, bot)
-
-        if hasattr(self, 'streamed') and self.streamed:
-            self.carousel = Carousel(self, bot)
+            self.turn_handle.defer(guild, bot)
 
         if hasattr(self, 'teamA') and self.teamA and not hasattr(self.teamA, 'role'):
             await self.teamA.resume(guild, bot, db)
@@ -241,7 +346,9 @@ class Match:
         if not await self.check('ban', handle, banned_map_id, force):
             return False
 
+        state = self.state_key()
         self.banned_maps.append(banned_map_id)
+        self.log_action(handle, 'ban', banned_map_id, state)
         print('{ch}: {team} banned map {map}'\
               .format(ch=handle.channel,
                       team=handle.team.name if handle.team else '<referee>',
@@ -255,7 +362,9 @@ class Match:
         if not await self.check('pick', handle, picked_map_id, force):
             return False
 
+        state = self.state_key()
         self.picked_maps.append(picked_map_id)
+        self.log_action(handle, 'pick', picked_map_id, state)
         print('{ch}: {team} picked map {map}'\
               .format(ch=handle.channel,
                       team=handle.team.name if handle.team else '<referee>',
@@ -272,7 +381,9 @@ class Match:
         if not await self.check('side', handle, side_id, force):
             return False
 
+        state = self.state_key()
         self.picked_sides.append(side_id)
+        self.log_action(handle, 'side', side_id, state)
         print('{ch}: {team} chose side {side}'\
               .format(ch=handle.channel,
                       team=handle.team.name if handle.team else '<referee>',
@@ -281,11 +392,33 @@ class Match:
         return True
 
     async def undo_map(self, handle):
+        state = self.state_key()
+        undone = self.undo()
+
+        # Even a failed undo may have moved the turn back
+        if self.state_key() != state:
+            self.log_action(handle, 'undo', None, state)
+
+        if undone is None:
+            await self.status(handle)
+            return True
+
+        if not undone:
+            await handle.reply('Cannot undo')
+            return False
+
+        print('{ch}: referee used undo'\
+              .format(ch=handle.channel))
+
+        await self.status(handle)
+        return True
+
+    ## Undo the last action, returns None if it only reopened the match
+    def undo(self):
         if self.force_done or self.auto_done:
             self.force_done = False
             self.auto_done = False
-            await self.status(handle)
-            return True
+            return None
 
         self.turn = self.turn - 1
         if self.turn < 0:
@@ -324,18 +457,12 @@ class Match:
         else:
             s = False
 
-        if not s:
-            await handle.reply('Cannot undo')
-            return False
-
-        print('{ch}: referee used undo'\
-              .format(ch=handle.channel))
-
-        await self.status(handle)
-        return True
+        return s
 
     async def close_match(self, handle):
+        state = self.state_key()
         self.force_done = True
+        self.log_action(handle, 'close', None, state)
         print('{ch}: Closed match'\
               .format(ch=handle.channel))
         await self.status(handle)
@@ -373,13 +500,7 @@ class Match:
         else:
             await self.status_handle.edit_embed(title, msg, status)
 
-        # If 1 map is remaining, it's a pick
-        if self.last_is_a_pick and \
-           not self.last_picked and \
-           len(self.maps) - len(self.banned_maps) - len(self.picked_maps) == 1:
-            map_id = next(e for e in self.maps if e not in self.banned_maps and e not in self.picked_maps)
-            self.picked_maps.append(map_id)
-            self.last_picked = True
+        self.pick_last_map()
 
         if self.turn < len(self.sequence) and not self.force_done:
             turn = '{turn} {team}! {use} `!{action} {choice}`.{extra}'\
@@ -399,9 +520,58 @@ class Match:
             if not self.turn_handle.message:
                 self.turn_handle.message = await handle.send(turn)
 
+    # If 1 map is remaining, it's a pick
+    def pick_last_map(self):
+        if self.last_is_a_pick and \
+           not self.last_picked and \
+           len(self.maps) - len(self.banned_maps) - len(self.picked_maps) == 1:
+            map_id = next(e for e in self.maps if e not in self.banned_maps and e not in self.picked_maps)
+            self.picked_maps.append(map_id)
+            self.last_picked = True
+
+    ## Where the match is in its ban/pick sequence, an action is only
+    ## replayed on the state it was done on
+    def state_key(self):
+        return [ self.turn,
+                 len(self.banned_maps),
+                 len(self.picked_maps),
+                 len(self.picked_sides),
+                 self.force_done,
+                 self.auto_done ]
+
+    ## Write the action to the action log of the guild before answering,
+    ## so that it survives a crash until the next save
+    def log_action(self, handle, action, value, state):
+        if self.bot:
+            self.bot.log_action(handle, self, action, value, state)
+
+    ## Apply a logged action again, without talking to Discord
+    def replay(self, action, value):
+        if action == 'ban':
+            self.banned_maps.append(value)
+            self.turn += 1
+        elif action == 'pick':
+            self.picked_maps.append(value)
+            self.turn += 1
+        elif action == 'side':
+            self.picked_sides.append(value)
+            self.turn += 1
+        elif action == 'undo':
+            # A failed undo does not update the status
+            if self.undo() is False:
+                return
+        elif action == 'close':
+            self.force_done = True
+
+        # What status() does after every action
+        self.pick_last_map()
+
     async def send_carousel(self, handle, text):
         message = None
 
+        if self.streamed and not self.carousel:
+            self.carousel = Carousel(self, self.bot)
+
         if self.carousel:
             self.carousel.update_status()
             self.carousel.save_status()
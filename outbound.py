@@ -0,0 +1,251 @@
+# The MIT License (MIT)
+# Copyright (c) 2017 Levak Borok <levak92@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+
+## Outbound Discord requests. Every REST call of the bot goes through one
+## scheduler that spaces the requests of a route with a token bucket, and all
+## of them with a global one, and only retries what Discord tells to retry.
+## When requests wait for the same bucket, the higher priority ones go first.
+
+import discord
+import asyncio
+import random
+import time
+import collections
+import contextlib
+import contextvars
+
+# Priorities, the lowest first
+INTERACTIVE = 0  # replies to captains and referees
+BROADCAST = 1    # announcements and broadcasts
+BULK = 2         # admin work on a whole cup or channel
+PRIORITIES = 3
+
+# Priority of the requests sent by the running task
+priority = contextvars.ContextVar('priority', default=INTERACTIVE)
+
+## Requests sent inside it, and by the tasks it starts, get this priority
+@contextlib.contextmanager
+def lane(prio):
+    token = priority.set(prio)
+    try:
+        yield
+    finally:
+        priority.reset(token)
+
+# Requests allowed per seconds of each route, by channel or guild. A 429
+# blocks the route for as long as Discord asks, whatever the limits here
+ROUTES = {
+    'message': (5, 5),      # send or edit a message, by channel
+    'delete': (5, 1),       # delete messages, by channel
+    'reaction': (1, 0.25),  # add or remove a reaction, by channel
+    'fetch': (5, 1),        # fetch a message, by channel
+    'permission': (10, 10), # edit permissions of a member, by channel
+    'member': (10, 10),     # roles and nickname of members, by guild
+    'role': (10, 10),       # create, edit or delete roles, by guild
+    'channel': (5, 5),      # create, edit or delete channels, by guild
+}
+
+# Requests allowed per seconds for the whole bot
+GLOBAL = (50, 1)
+
+### Requests that can be sent now, refilled over time
+class TokenBucket:
+    def __init__(self, rate, per):
+        self.rate = rate
+        self.per = per
+        self.tokens = rate
+        self.updated = time.monotonic()
+
+        # Until when Discord asked us to wait
+        self.blocked = 0
+
+        # Requests waiting for a token, oldest first, by priority
+        self.waiters = [ collections.deque() for _ in range(PRIORITIES) ]
+
+        # Wakes the next waiter once a token is back
+        self.timer = None
+
+    ## Seconds before a request can be sent
+    def wait(self, now):
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate / self.per)
+        self.updated = now
+
+        wait = (1 - self.tokens) * self.per / self.rate if self.tokens < 1 else 0
+        return max(wait, self.blocked - now)
+
+    def take(self):
+        self.tokens -= 1
+
+    def block(self, seconds):
+        self.blocked = max(self.blocked, time.monotonic() + seconds)
+
+    def idle(self, now):
+        return self.wait(now) <= 0 and self.tokens >= self.rate \
+            and not any(self.waiters)
+
+    ## Wait for a token. Requests get them in order, the higher priority ones
+    ## first
+    async def acquire(self, prio):
+        if not any(self.waiters) and self.wait(time.monotonic()) <= 0:
+            self.take()
+            return
+
+        future = asyncio.get_event_loop().create_future()
+        self.waiters[prio].append(future)
+        self.wake()
+
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future in self.waiters[prio]:
+                self.waiters[prio].remove(future)
+            elif future.done() and not future.cancelled():
+                # Cancelled after being given a token, give it back
+                self.tokens += 1
+            self.wake()
+            raise
+
+    ## Give the tokens available to the oldest waiters of the highest
+    ## priority, and plan to come back when the next one refills
+    def wake(self):
+        if self.timer:
+            return
+
+        while True:
+            queue = next((q for q in self.waiters if q), None)
+            if not queue:
+                return
+
+            wait = self.wait(time.monotonic())
+            if wait > 0:
+                self.timer = asyncio.get_event_loop().call_later(wait, self.refilled)
+                return
+
+            future = queue.popleft()
+            if not future.done():
+                self.take()
+                future.set_result(None)
+
+    def refilled(self):
+        self.timer = None
+        self.wake()
+
+class Outbound:
+    # Attempts of a request before giving up
+    RETRIES = 5
+
+    # discord.py already retried a server error 5 times before raising it,
+    # and sending a message or creating a channel again may duplicate it
+    SERVER_RETRIES = 1
+
+    # Backoff of server errors, doubled at each retry
+    BACKOFF = 1
+    BACKOFF_MAX = 30
+
+    # Buckets kept before forgetting the idle ones
+    MAX_BUCKETS = 1024
+
+    def __init__(self, routes=ROUTES, global_limit=GLOBAL):
+        self.routes = routes
+        self.global_bucket = TokenBucket(*global_limit)
+        self.buckets = {}
+
+        # Requests sent, retried and given up, by route
+        self.sent = collections.Counter()
+        self.retried = collections.Counter()
+        self.failed = collections.Counter()
+
+    def bucket(self, route, major):
+        key = (route, major)
+        if key not in self.buckets:
+            if len(self.buckets) >= self.MAX_BUCKETS:
+                now = time.monotonic()
+                for k in [ k for k, b in self.buckets.items() if b.idle(now) ]:
+                    del self.buckets[k]
+
+            self.buckets[key] = TokenBucket(*self.routes[route])
+
+        return self.buckets[key]
+
+    async def acquire(self, bucket, prio):
+        await bucket.acquire(prio)
+        await self.global_bucket.acquire(prio)
+
+    ## Seconds to wait before retrying a failed request, None if it cannot be.
+    ## `server_errors` is how many server errors the request already had
+    def retry_delay(self, e, bucket, server_errors):
+        status = getattr(e, 'status', None)
+        headers = getattr(getattr(e, 'response', None), 'headers', None) or {}
+
+        if status == 429:
+            try:
+                retry_after = float(headers.get('Retry-After')
+                                    or headers.get('X-RateLimit-Reset-After'))
+            except (TypeError, ValueError):
+                retry_after = self.BACKOFF
+
+            # Everyone waits, not only this route
+            if headers.get('X-RateLimit-Global'):
+                self.global_bucket.block(retry_after)
+            else:
+                bucket.block(retry_after)
+            return retry_after
+
+        if status is not None and status >= 500:
+            if server_errors >= self.SERVER_RETRIES:
+                return None
+            backoff = min(self.BACKOFF_MAX, self.BACKOFF * 2 ** server_errors)
+            return backoff * random.uniform(0.5, 1.5)
+
+        # Forbidden, not found, bad request...
+        return None
+
+    ## Send a request on a route, `major` being the channel or guild ID that
+    ## Discord rate limits it by. `fn(*args, **kwargs)` is called at each
+    ## attempt and the last error is raised when giving up. The priority is
+    ## the one of the current lane unless given
+    async def call(self, route, major, fn, *args, prio=None, **kwargs):
+        bucket = self.bucket(route, major)
+        prio = priority.get() if prio is None else prio
+        attempt = 0
+        server_errors = 0
+
+        while True:
+            await self.acquire(bucket, prio)
+
+            try:
+                self.sent[route] += 1
+                return await fn(*args, **kwargs)
+            except discord.errors.HTTPException as e:
+                delay = self.retry_delay(e, bucket, server_errors)
+                attempt += 1
+                if (getattr(e, 'status', None) or 0) >= 500:
+                    server_errors += 1
+                if delay is None or attempt >= self.RETRIES:
+                    self.failed[route] += 1
+                    raise
+
+                print('WARNING: HTTPexception: {}, retrying {} in {:.1f}s'\
+                      .format(str(e), route, delay))
+                self.retried[route] += 1
+                if delay > 0:
+                    await asyncio.sleep(delay)
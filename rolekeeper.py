@@ -36,26 +36,14 @@ import time
 from team import Team, TeamCaptain, Cup, Group
 from match import Match, MatchBo2, MatchBo3, MatchBo5, MatchFFA
 from inputs import *
-from db import open_db
+from db import open_db, has_cups
 from handle import Handle
 from esports_driver import EsportsDriver
+from indexes import GuildIndex, MemberIndex
+from outbound import Outbound
 
 import locale_s
 
-# Version of Shelf.sync that doesn't flush the cache
-def shelf_invalidate(shelf):
-    if shelf.writeback and shelf.cache:
-        shelf.writeback = False
-        for key, entry in shelf.cache.items():
-            shelf[key] = entry
-        shelf.writeback = True
-    if hasattr(shelf.dict, 'reorganize'):
-        shelf.dict.reorganize()
-        print('reorganized')
-    if hasattr(shelf.dict, 'sync'):
-        shelf.dict.sync()
-        print('synced')
-
 class RoleKeeper:
     def __init__(self, client, config_file):
         self.client = client
@@ -96,9 +84,38 @@ class RoleKeeper:
         if 'autosave' in self.config:
             autosave = self.config['autosave']
 
-        self.sync_db_task = self.cron(autosave, self.sync_db)
+        journal = 60
+        if 'journal' in self.config:
+            journal = self.config['journal']
+
+        self.resume_concurrency = 5
+        if 'resume_concurrency' in self.config:
+            self.resume_concurrency = self.config['resume_concurrency']
+        self.resume_semaphore = None
+
+        self.evict_idle = 3600
+        if 'evict_idle' in self.config:
+            self.evict_idle = self.config['evict_idle']
+
+        # Guild DBs being opened or closed, and when each guild was last used
+        self.db_tasks = {}
+        self.last_used = {}
+
+        # Lookup tables of each guild (see indexes.py)
+        self.index = {}
+
+        # (is_admin, is_ref, is_streamer) of members by guild and member ID
+        self.permissions = {}
+
+        self.sync_db_task = self.cron(journal, self.sync_db)
+        self.compact_db_task = self.cron(autosave, self.compact_db)
+        self.evict_db_task = self.cron(60, self.evict_idle_dbs) \
+                             if self.evict_idle > 0 else None
         self.reaction_handlers = {}
 
+        # Every Discord request goes through it (see outbound.py)
+        self.outbound = Outbound()
+
     def get_config(self, path):
         try:
             with open(path, 'r') as f:
@@ -117,29 +134,53 @@ class RoleKeeper:
         async def loop():
             while True:
                 await asyncio.sleep(secs)
-                callback(*args)
+                ret = callback(*args)
+                if asyncio.iscoroutine(ret):
+                    await ret
 
         return self.client.loop.create_task(loop())
 
-    def sync_db(self):
+    # Append what changed since last time to the journal. Only taking the
+    # snapshots blocks the loop, they are written by the DB writer threads
+    async def sync_db(self):
         if self.db:
-            for guild, db in self.db.items():
+            futures = []
+            for guild, db in list(self.db.items()):
                 if 'sroles' in db:
                     del db['sroles']
+                future = db.sync_background()
+                if future:
+                    futures.append(asyncio.wrap_future(future))
+
+            await asyncio.gather(*futures)
+
+    # Fold the journal into a new snapshot
+    async def compact_db(self):
+        if self.db:
+            futures = []
+            for guild, db in list(self.db.items()):
                 print ('Automatically save DB "{}"'.format(guild.name))
-                shelf_invalidate(db)
+                db.sync_background(check=True)
+                futures.append(asyncio.wrap_future(db.compact()))
+
+            await asyncio.gather(*futures)
 
     def atexit(self):
         if self.sync_db_task:
             self.sync_db_task.cancel()
 
+        if self.compact_db_task:
+            self.compact_db_task.cancel()
+
+        if self.evict_db_task:
+            self.evict_db_task.cancel()
+
         if self.db:
             for guild, db in self.db.items():
                 try:
                     print ('Closing DB "{}"'.format(guild.name))
                 except BrokenPipeError:
                     pass
-                shelf_invalidate(db)
                 db.close()
             self.db = None
 
@@ -148,6 +189,54 @@ class RoleKeeper:
             return False
         return True
 
+    ## Make sure the DB of a guild is loaded before handling one of its events
+    async def use_guild(self, guild):
+        self.last_used[guild] = time.monotonic()
+
+        if guild in self.db_tasks:
+            await self.db_tasks[guild]
+
+        if guild not in self.db or not self.db[guild]:
+            await self.run_db_task(guild, self.open_db(guild))
+
+    ## DB of a guild if it is loaded, for events that do not count as using
+    ## it. Guilds with cups are always loaded, the others have no captains
+    async def loaded_db(self, guild):
+        if guild in self.db_tasks:
+            await self.db_tasks[guild]
+
+        return self.db.get(guild)
+
+    ## Open or close the DB of a guild, one at a time
+    async def run_db_task(self, guild, coro):
+        task = asyncio.ensure_future(coro)
+        self.db_tasks[guild] = task
+        try:
+            await task
+        finally:
+            if self.db_tasks.get(guild) is task:
+                del self.db_tasks[guild]
+
+    ## Save and unload the DBs of guilds without cups nobody used for a while
+    async def evict_idle_dbs(self):
+        now = time.monotonic()
+
+        for guild, db in list(self.db.items()):
+            if guild in self.db_tasks \
+               or (db and len(db.get('cups', {})) > 0) \
+               or now - self.last_used.get(guild, now) < self.evict_idle:
+                continue
+
+            await self.run_db_task(guild, self.close_db(guild))
+
+    async def close_db(self, guild):
+        db = self.db.pop(guild)
+        self.index.pop(guild, None)
+        self.permissions.pop(guild, None)
+        print('{}: Unload idle DB'.format(guild.name))
+        if db:
+            await self.client.loop.run_in_executor(None, db.close)
+
     # Parse header from CSV file
     def parse_header(self, header):
         return { e: header.index(e) for e in header }
@@ -286,14 +375,15 @@ class RoleKeeper:
         return captains, groups
 
     async def get_or_create_role(self, guild, role_name, color=None):
-        role = discord.utils.get(guild.roles, name=role_name)
+        role = self.get_role(guild, role_name)
 
         if not role:
-            role = await guild.create_role(
+            role = await self.outbound.call('role', guild.id, guild.create_role,
                 name=role_name,
                 permissions=discord.Permissions.none(),
                 mentionable=True,
                 color=discord.Colour(color))
+            self.index_role(role)
 
             print('Create new role <{role}>'\
                   .format(role=role_name))
@@ -306,17 +396,49 @@ class RoleKeeper:
         if guild in self.db and self.db[guild]:
             return
 
-        self.db[guild] = open_db(self.config['guilds'][guild.name]['db'])
+        start = time.perf_counter()
+        fetches = Handle.fetches[guild.id]
+
+        storage = 'journal'
+        if 'storage' in self.config:
+            storage = self.config['storage']
+
+        self.db[guild] = open_db(self.config['guilds'][guild.name]['db'], storage=storage)
 
         if 'cups' not in self.db[guild]:
             self.db[guild]['cups'] = {}
 
+        self.index[guild] = GuildIndex(guild)
+        for cup_name, cup_db in self.db[guild]['cups'].items():
+            if 'captains' in cup_db:
+                self.index_cup(guild, cup_db)
+
+            if 'matches' in cup_db:
+                for channel_name in cup_db['matches'].keys():
+                    channel = self.get_channel(guild, channel_name)
+                    if channel:
+                        self.index_match(guild, cup_db, channel)
+
+            if 'hunt' in cup_db and 'channel_id' in cup_db['hunt']:
+                self.index[guild].hunts.add(cup_db['hunt']['channel_id'], cup_name)
+
+            if cup_db.get('players'):
+                self.index[guild].players.update_cup(cup_name, cup_db['players'])
+
+            # Saved by an older version, it is in the index now
+            if 'players-by-nick' in cup_db:
+                del cup_db['players-by-nick']
+
+        # Resumes that need REST calls, run concurrently once the ones only
+        # using the cache are done
+        resumes = []
+
         for cup_name, cup_db in self.db[guild]['cups'].items():
             if 'cup' in cup_db:
                 await cup_db['cup'].resume(guild, self, cup_db)
 
             if 'driver' in cup_db:
-                await cup_db['driver'].resume(guild, self, cup_db)
+                resumes.append(cup_db['driver'].resume(guild, self, cup_db))
 
             if 'teams' in cup_db:
                 for _, team in cup_db['teams'].items():
@@ -339,16 +461,36 @@ class RoleKeeper:
                     if 'handle' in rewards_db:
                         handle = rewards_db['handle']
                         try:
-                            await handle.resume(guild, self)
+                            # The reaction event brings the message, no
+                            # need to fetch it
+                            handle.defer(guild, self)
                             print('Resume handle for captain {}'.format(str(captain)))
-                            self.register_reaction_handler(handle.message, self.on_captain_reaction, captain=captain, db=cup_db)
+                            self.register_reaction_handler(handle.message_id, self.on_captain_reaction, captain=captain, db=cup_db)
                         except:
                             print('Error when resuming handle for captain {}'.format(str(captain)))
 
+        await self.run_resumes(resumes)
+
+        print('{}: Resumed DB in {:.2f}s ({} REST fetches)'\
+              .format(guild.name, time.perf_counter() - start,
+                      Handle.fetches[guild.id] - fetches))
+
         # Refill group cache
-        self.cache_special_role(guild, 'referee')
-        self.cache_special_role(guild, 'coreferee')
-        self.cache_special_role(guild, 'streamer')
+        self.cache_special_roles(guild)
+
+    # Log a match action before answering it (see GuildDB.log_action)
+    def log_action(self, handle, match, action, value, state):
+        guild = handle.channel.guild
+        if not self.db or guild not in self.db or not self.db[guild]:
+            return
+
+        db, found = self.find_match(guild, handle.channel)
+        if found is not match:
+            return
+
+        self.db[guild].log_action(db['cup'].name, handle.channel.name, action, value,
+                                  handle.member.id if handle.member else None,
+                                  state)
 
     def open_cup_db(self, guild, cup):
         cup.name = cup.name.upper()
@@ -380,8 +522,70 @@ class RoleKeeper:
             return False
 
         del self.db[guild]['cups'][cup_name]
+        self.index[guild].drop_cup(cup_name)
         return True
 
+    ## Keep the captain index in sync once a captain changed or was removed
+    def index_captain(self, guild, db, captain):
+        self.index[guild].captains.update(db['cup'].name, db['captains'], captain)
+
+    def index_cup(self, guild, db):
+        self.index[guild].captains.update_cup(db['cup'].name, db['captains'])
+
+    def index_match(self, guild, db, channel):
+        self.index[guild].matches.add(channel.id, db['cup'].name, channel.name)
+
+    ## Tell, without loading anything, if a message that is not a command may
+    ## still be for us: pick&ban shortcuts in match rooms and messages in
+    ## captain hunt channels
+    def wants_message(self, message, shortcut):
+        guild = message.guild
+
+        # Still loading, we cannot tell yet
+        if guild in self.db_tasks:
+            return True
+
+        if guild not in self.index:
+            return False
+
+        index = self.index[guild]
+        return (shortcut and message.channel.id in index.matches) \
+            or message.channel.id in index.hunts
+
+    ## Find the cup and match played in a channel
+    def find_match(self, guild, channel):
+        if guild not in self.index:
+            return None, None
+
+        return self.index[guild].matches.find(self.db[guild]['cups'], channel.id)
+
+    ## Find a channel, role or category by name, without going through all
+    ## the ones of the guild once its DB is loaded
+    def get_channel(self, guild, name):
+        if guild in self.index:
+            return self.index[guild].names.get_channel(name)
+        return discord.utils.get(guild.channels, name=name)
+
+    def get_role(self, guild, name):
+        if guild in self.index:
+            return self.index[guild].names.get_role(name)
+        return discord.utils.get(guild.roles, name=name)
+
+    def get_category(self, guild, cat_id):
+        if 'categories' not in self.config['guilds'][guild.name] \
+           or cat_id not in self.config['guilds'][guild.name]['categories']:
+            return None
+
+        cat_name = self.config['guilds'][guild.name]['categories'][cat_id]
+        if guild in self.index:
+            return self.index[guild].names.get_category(guild, cat_name)
+
+        category = None
+        for ch in guild.channels:
+            if cat_name.lower() in ch.name.lower():
+                category = ch
+        return category
+
     def get_cup_db(self, guild, cup_name):
         if guild not in self.db:
             return None, "This guild is either not configured to run any cup" \
@@ -409,42 +613,74 @@ class RoleKeeper:
         else:
             return None, 'No such cup is running'
 
+    ## Find a captain of a cup by nickname or team name, from the cup indexes
+    ## if they are up to date
+    def find_captain(self, db, nickname=None, team_name=None):
+        index, attr, value = ('captains-by-nick', 'nickname', nickname) if nickname \
+                             else ('captains-by-team', 'team_name', team_name)
+
+        captain = db[index].get(value) if index in db else None
+        if captain \
+           and getattr(captain, attr) == value \
+           and db['captains'].get(captain.key) is captain:
+            return captain
+
+        return next((c for c in db['captains'].values() if getattr(c, attr) == value), None)
+
     def find_cup_db(self, guild, discord=None, captain=None, match=None, hunt=None):
         if guild not in self.db:
             return None, "This guild is not running any cups", None
 
-        if discord: # SLOW!
-            for cup_name, db in self.db[guild]['cups'].items():
-                for id, captain in db['captains'].items():
-                    if captain.discord == discord:
-                        return db, None, captain
-        elif captain:
-            for cup_name, db in self.db[guild]['cups'].items():
-                if captain in db['captains']:
-                    return db, None, db['captains'][captain]
+        if discord or captain:
+            db, captain = self.index[guild].captains.find(self.db[guild]['cups'],
+                                                         discord=discord,
+                                                         key=captain)
+            if db:
+                return db, None, captain
         elif match:
             for cup_name, db in self.db[guild]['cups'].items():
                 if match in db['matches']:
                     return db, None, db['matches'][match]
         elif hunt:
-            for cup_name, db in self.db[guild]['cups'].items():
-                if 'hunt' in db \
-                   and 'channel_id' in db['hunt'] \
-                   and hunt.id == db['hunt']['channel_id']:
-                    return db, None, hunt
+            db = self.index[guild].hunts.find(self.db[guild]['cups'], hunt.id)
+            if db:
+                return db, None, hunt
 
         return None, 'No cup was found that contains this user or match', None
 
     # Acknowledgement that we are succesfully connected to Discord
     async def on_ready(self):
+        guilds = []
 
         for guild in self.client.guilds:
             print('Guild: {}'.format(guild))
 
-            if self.check_guild(guild):
-                await self.open_db(guild)
-            else:
+            if not self.check_guild(guild):
                 print ('WARNING: Guild "{}" not configured!'.format(guild.name))
+            elif has_cups(self.config['guilds'][guild.name]['db']):
+                guilds.append(guild)
+            else:
+                print ('{}: DB will be loaded on first use'.format(guild.name))
+
+        # Resume all guilds at once, they share the REST concurrency cap
+        await asyncio.gather(*[ self.use_guild(guild) for guild in guilds ])
+
+    ## Run resumes concurrently, no more than resume_concurrency at a time
+    ## so that we stay under Discord rate limits
+    async def run_resumes(self, resumes):
+        if not self.resume_semaphore:
+            self.resume_semaphore = asyncio.Semaphore(self.resume_concurrency)
+
+        async def run(resume):
+            async with self.resume_semaphore:
+                try:
+                    await resume
+                except:
+                    import traceback
+                    traceback.print_exc()
+                    print('ERROR Failed to resume')
+
+        await asyncio.gather(*[ run(resume) for resume in resumes ])
 
     async def on_dm(self, message):
         # If it is us sending the DM, exit
@@ -463,8 +699,16 @@ class RoleKeeper:
         if member.guild.name not in self.config['guilds']:
             return
 
+        await self.use_guild(member.guild)
+
+        self.roles_changed(member, added=member.roles)
+
         await self.handle_member_join(member)
 
+    async def on_member_remove(self, member):
+        self.roles_changed(member, removed=member.roles)
+        self.permissions.get(member.guild, {}).pop(member.id, None)
+
     async def on_member_update(self, before, after):
         guild = after.guild if hasattr(after, 'guild') and after.guild \
                 else before.guild if hasattr(before, 'guild') \
@@ -473,6 +717,12 @@ class RoleKeeper:
         if not guild or guild.name not in self.config['guilds']:
             return
 
+        # The role holders of a guild not loaded are counted when it loads
+        if before.roles != after.roles:
+            self.permissions.get(guild, {}).pop(after.id, None)
+            if guild in self.index:
+                self.index[guild].holders.update(before, after)
+
         # Try to find missing captains with rich-presence updates
 
         # App IDs to track
@@ -489,15 +739,21 @@ class RoleKeeper:
                         nickname = activity.large_image_text
                         break
 
-        # This event is indeed a rich-presence update for a tracked application
-        if nickname:
-            for cup_name, db in self.db[guild]['cups'].items():
+        # This event is not a rich-presence update for a tracked application
+        if not nickname:
+            return
 
-                captain = db['captains-by-nick'][nickname] if nickname in db['captains-by-nick'] else None
-                # Then only, search for the nicknames
-                if captain and not captain.member:
-                        print('Update "{}" via rich-presence from {}'.format(nickname, str(after)))
-                        await self.update_captain(None, guild, after, nickname, cup_name)
+        guild_db = await self.loaded_db(guild)
+        if not guild_db:
+            return
+
+        for cup_name, db in guild_db['cups'].items():
+
+            captain = db['captains-by-nick'][nickname] if nickname in db['captains-by-nick'] else None
+            # Then only, search for the nicknames
+            if captain and not captain.member:
+                    print('Update "{}" via rich-presence from {}'.format(nickname, str(after)))
+                    await self.update_captain(None, guild, after, nickname, cup_name)
 
 
     async def on_user_update(self, before, after):
@@ -515,7 +771,10 @@ class RoleKeeper:
         if before_discord_id == after_discord_id:
             return
 
-        _, _, captain = self.find_cup_db(guild, captain=before.id)
+        if not await self.loaded_db(guild):
+            return
+
+        db, _, captain = self.find_cup_db(guild, captain=before.id)
 
         # A known captain changed ID
         if captain:
@@ -523,6 +782,7 @@ class RoleKeeper:
                   .format(before_discord_id,
                           after_discord_id))
             captain.discord = after_discord_id
+            self.index_captain(guild, db, captain)
         else:
             # Try to find the captain discord ID in the DB
             _, error, _ = self.find_cup_db(after.guild, discord=after_discord_id)
@@ -530,6 +790,54 @@ class RoleKeeper:
                 # If found, update him
                 await self.handle_member_join(after)
 
+    ## Keep the channel and role names of loaded guilds up to date
+    async def on_guild_channel_create(self, channel):
+        self.index_channel(channel)
+
+    async def on_guild_channel_delete(self, channel):
+        if channel.guild in self.index:
+            self.index[channel.guild].names.remove_channel(channel)
+
+    async def on_guild_channel_update(self, before, after):
+        if after.guild in self.index:
+            self.index[after.guild].names.remove_channel(before)
+            self.index[after.guild].names.add_channel(after)
+
+    async def on_guild_role_create(self, role):
+        self.index_role(role)
+        self.cache_special_roles(role.guild)
+
+    async def on_guild_role_delete(self, role):
+        if role.guild in self.index:
+            self.index[role.guild].names.remove_role(role)
+            self.cache_special_roles(role.guild)
+
+    async def on_guild_role_update(self, before, after):
+        if after.guild in self.index:
+            self.index[after.guild].names.remove_role(before)
+            self.index[after.guild].names.add_role(after)
+            self.cache_special_roles(after.guild)
+
+    def index_channel(self, channel):
+        if channel.guild in self.index:
+            self.index[channel.guild].names.add_channel(channel)
+
+    def index_role(self, role):
+        if role.guild in self.index:
+            self.index[role.guild].names.add_role(role)
+
+    ## Record role changes done by the bot without waiting for the member
+    ## update event
+    def roles_changed(self, member, added=(), removed=()):
+        if member.guild in self.index:
+            self.index[member.guild].holders.add(member, added)
+            self.index[member.guild].holders.remove(member, removed)
+
+    def has_role_holders(self, guild, role):
+        if guild in self.index:
+            return self.index[guild].holders.count(role) > 0
+        return any(role in m.roles for m in guild.members)
+
     def get_nick_name(self, db, captain):
         nickname = captain.nickname
         if not db['with_roles']:
@@ -606,12 +914,46 @@ class RoleKeeper:
         # Trick to make sure the structures are there
         self.get_special_role(guild, role_id)
 
-        role = discord.utils.get(guild.roles, name=role_name)
+        role = self.get_role(guild, role_name)
 
         self.cache[guild]['sroles'][role_id] = role
         if not self.cache[guild]['sroles'][role_id]:
             print ('WARNING: Missing role "{}" in {}'.format(role_name, guild.name))
 
+    ## Special roles are looked up once their guild is loaded and whenever
+    ## roles change, permissions depend on them
+    def cache_special_roles(self, guild):
+        if guild not in self.index:
+            return
+
+        self.cache_special_role(guild, 'referee')
+        self.cache_special_role(guild, 'coreferee')
+        self.cache_special_role(guild, 'streamer')
+        self.permissions.pop(guild, None)
+
+    ## Tell if a member is admin, referee or streamer, using the special roles
+    ## cached by ID. It is cached until the roles of the member change.
+    def get_permissions(self, member):
+        guild = member.guild
+        permissions = self.permissions.setdefault(guild, {})
+
+        if member.id not in permissions:
+            if guild not in self.cache or 'sroles' not in self.cache[guild]:
+                self.cache_special_role(guild, 'referee')
+                self.cache_special_role(guild, 'streamer')
+
+            role_ids = { r.id for r in member.roles }
+            ref_role = self.get_special_role(guild, 'referee')
+            streamer_role = self.get_special_role(guild, 'streamer')
+
+            is_admin = member.guild_permissions.manage_roles
+            is_ref = is_admin or bool(ref_role and ref_role.id in role_ids)
+            is_streamer = is_ref or bool(streamer_role and streamer_role.id in role_ids)
+
+            permissions[member.id] = (is_admin, is_ref, is_streamer)
+
+        return permissions[member.id]
+
     def get_special_role(self, guild, role_id):
         if not self.cache:
             self.cache = {}
@@ -674,7 +1016,8 @@ class RoleKeeper:
                     continue
 
                 try:
-                    await cpt.remove_roles(group.role)
+                    await self.outbound.call('member', cpt.guild.id, cpt.remove_roles, group.role)
+                    self.roles_changed(cpt, removed=[ group.role ])
                     print ('Removed role "{grole}" from "{member}"'\
                            .format(member=str(member),
                                    grole=group.name))
@@ -718,6 +1061,7 @@ class RoleKeeper:
         db['captains'][member.id] = captain
         db['captains-by-nick'][nick] = captain
         db['captains-by-team'][team] = captain
+        self.index_captain(guild, db, captain)
 
         # Trigger update on member
         await self.handle_member_join(member, db)
@@ -765,6 +1109,7 @@ class RoleKeeper:
         captain.key = member.id # TODO Workaround
         captain.discord = discord_id
         old_member = captain.member
+        self.index_captain(guild, db, captain)
 
         # Trigger update on member
         await self.handle_member_join(member, db)
@@ -814,7 +1159,7 @@ class RoleKeeper:
 
         if team.role:
             try:
-                await team.role.edit(name=new_role_name)
+                await self.outbound.call('role', team.role.guild.id, team.role.edit, name=new_role_name)
             except:
                 print('WARNING: Failed to rename role to "{}"'.format(new_role_name))
                 pass
@@ -823,7 +1168,7 @@ class RoleKeeper:
                 new_nickname = self.get_nick_name(db, captain)
 
                 try:
-                    await captain.member.edit(nick=new_nickname)
+                    await self.outbound.call('member', captain.member.guild.id, captain.member.edit, nick=new_nickname)
                     print ('Renamed "{id}" to "{nick}"'\
                            .format(id=str(captain.member), nick=new_nickname))
                 except:
@@ -868,10 +1213,10 @@ class RoleKeeper:
             if not captain.member or not match.is_in_match(captain.member):
                 continue
 
-            channel = discord.utils.get(guild.channels, name=channel_name)
+            channel = self.get_channel(guild, channel_name)
             if channel:
                 try:
-                    await channel.set_permissions(member, overwrite=None)
+                    await self.outbound.call('permission', channel.id, channel.set_permissions, member, overwrite=None)
 
                     print('Deleted permissions for "{discord}" in channel "<{channel}>"'\
                           .format(discord=discord_id,
@@ -894,7 +1239,8 @@ class RoleKeeper:
 
         # Remove team, team captain and group roles from member
         try:
-            await member.remove_roles(*role_list)
+            await self.outbound.call('member', member.guild.id, member.remove_roles, *role_list)
+            self.roles_changed(member, removed=role_list)
 
             print ('Removed roles <{roles}> from "{member}"'\
                    .format(member=discord_id,
@@ -907,7 +1253,6 @@ class RoleKeeper:
 
         # Check if the role is now orphan, and delete it
 
-        members = list(guild.members)
         team = captain.team
         team_role = team.role if team else None
         trole_name = team_role.name if team_role else ''
@@ -915,9 +1260,9 @@ class RoleKeeper:
         if team and team.captains and member.id in team.captains:
             del team.captains[member.id]
 
-        if team_role and not any(r == team_role for m in members for r in m.roles):
+        if team_role and not self.has_role_holders(guild, team_role):
             try:
-                await team_role.delete()
+                await self.outbound.call('role', team_role.guild.id, team_role.delete)
                 print ('Deleted role "{role}"'\
                        .format(role=trole_name))
             except:
@@ -930,7 +1275,7 @@ class RoleKeeper:
 
         # Reset member nickname
         try:
-            await member.edit(nick=None)
+            await self.outbound.call('member', member.guild.id, member.edit, nick=None)
             print ('Reset nickname for "{member}"'\
                    .format(member=discord_id))
         except:
@@ -945,6 +1290,7 @@ class RoleKeeper:
             del db['captains-by-team'][captain.team_name]
         if member.id in db['captains']:
             del db['captains'][member.id]
+        self.index_captain(guild, db, captain)
 
         return True
 
@@ -1007,9 +1353,9 @@ class RoleKeeper:
             if member.id in db['captains']:
                 captain = db['captains'][member.id]
             else:
-                for _, c in db['captains'].items():
-                    if c.discord == discord_id:
-                        captain = c
+                _, captain = self.index[guild].captains.find(self.db[guild]['cups'],
+                                                            discord=discord_id,
+                                                            cup_name=db['cup'].name)
 
         # Check that the captain is indeed in our list
         if not captain:
@@ -1034,6 +1380,7 @@ class RoleKeeper:
         captain.key = member.id
         db['captains'][captain.key] = captain
         captain.discord = discord_id
+        self.index_captain(guild, db, captain)
 
         # Assign user roles
         if team and team.role and team.role not in member.roles:
@@ -1046,7 +1393,8 @@ class RoleKeeper:
         role_names = [ r.name for r in role_list ]
         if len(role_list) > 0:
             try:
-                await member.add_roles(*role_list)
+                await self.outbound.call('member', member.guild.id, member.add_roles, *role_list)
+                self.roles_changed(member, added=role_list)
                 print('Assigned roles <{role}> to "{id}"'\
                       .format(role=role_names, id=discord_id))
             except:
@@ -1058,7 +1406,7 @@ class RoleKeeper:
 
         if nickname != member.nick:
             try:
-                await member.edit(nick=nickname)
+                await self.outbound.call('member', member.guild.id, member.edit, nick=nickname)
                 print ('Renamed "{id}" to "{nick}"'\
                        .format(id=discord_id, nick=nickname))
             except:
@@ -1071,13 +1419,13 @@ class RoleKeeper:
             if not match.is_in_match(member):
                 continue
 
-            channel = discord.utils.get(guild.channels, name=channel_name)
+            channel = self.get_channel(guild, channel_name)
             if channel:
                 try:
                     overwrite = discord.PermissionOverwrite()
                     overwrite.read_messages = True
                     overwrite.send_messages = True
-                    await channel.set_permissions(member, overwrite=overwrite)
+                    await self.outbound.call('permission', channel.id, channel.set_permissions, member, overwrite=overwrite)
 
                     print('Edited permissions for channel "<{channel}>"'\
                           .format(channel=channel_name))
@@ -1092,13 +1440,29 @@ class RoleKeeper:
         acc = ''
         for l in msg.splitlines():
             if len(acc) + len(l) >= 2000:
-                await channel.send(content=acc)
+                await self.outbound.call('message', channel.id, channel.send, content=acc)
                 acc = l
             else:
                 acc = '{}\n{}'.format(acc, l)
 
-        return await channel.send(content=acc)
+        return await self.outbound.call('message', channel.id, channel.send, content=acc)
+
+    # Edit a message sent by the bot
+    async def edit_message(self, message, msg):
+        return await self.outbound.call('message', message.channel.id, message.edit, content=msg)
+
+    # Delete a message
+    async def delete_message(self, message):
+        return await self.outbound.call('delete', message.channel.id, message.delete)
 
+    # Send a file in a channel
+    async def send_file(self, channel, fp, filename, msg=None):
+        # The file is read again if the request is retried
+        async def send():
+            fp.seek(0)
+            return await channel.send(file=discord.File(fp=fp, filename=filename), content=msg)
+
+        return await self.outbound.call('message', channel.id, send)
 
     # Reply to a message in a channel
     async def reply(self, message, reply):
@@ -1263,7 +1627,7 @@ class RoleKeeper:
 
         while True:
             channel_name = '{}{}'.format(base_name, index_str)
-            channel = discord.utils.get(guild.channels, name=channel_name)
+            channel = self.get_channel(guild, channel_name)
 
             # Channel already exists, but we do not know if we should reuse it
             if (channel or channel_name in db['matches']) and reuse == self.REUSE_UNK:
@@ -1327,13 +1691,7 @@ class RoleKeeper:
         if not channel_name:
             return False, None
 
-        category = None
-        if 'categories' in self.config['guilds'][guild.name] \
-           and cat_id in self.config['guilds'][guild.name]['categories']:
-            cat_name = self.config['guilds'][guild.name]['categories'][cat_id]
-            for ch in guild.channels:
-                if cat_name.lower() in ch.name.lower():
-                    category = ch
+        category = self.get_category(guild, cat_id)
 
         if cat_id and len(cat_id) > 0 and not category:
             await self.reply(message, ':warning: Cannot find category with ID "{}"'.format(cat_id))
@@ -1356,10 +1714,11 @@ class RoleKeeper:
                     if captain.member:
                         overrides[captain.member] = read_perms
 
-                channel = await guild.create_text_channel(
+                channel = await self.outbound.call('channel', guild.id, guild.create_text_channel,
                     channel_name,
                     overwrites=overrides,
                     category=category)
+                self.index_channel(channel)
 
                 print('Created channel "<{channel}>"'\
                       .format(channel=channel_name))
@@ -1369,7 +1728,7 @@ class RoleKeeper:
                 raise e
 
             try:
-                await channel.edit(topic=topic)
+                await self.outbound.call('channel', channel.guild.id, channel.edit, topic=topic)
 
                 print('Set topic for channel "<{channel}>" to "{topic}"'\
                       .format(channel=channel_name, topic=topic))
@@ -1382,6 +1741,7 @@ class RoleKeeper:
 
         # Start the match
         db['matches'][channel_name] = match
+        self.index_match(guild, db, channel)
         handle = Handle(self, channel=channel)
         await match.begin(handle)
 
@@ -1408,27 +1768,19 @@ class RoleKeeper:
             csv.close()
 
             for player_name in player_names:
-                found = False
-                for captain in db['captains'].values():
-                    if player_name == captain.nickname:
-                        players.append(captain)
-                        found = True
-                        break
-
-                if not found:
+                captain = self.find_captain(db, nickname=player_name)
+                if captain:
+                    players.append(captain)
+                else:
                     await self.reply(message, ':warning: Cannot find player "{}"'.format(player_name))
 
         elif team_names:
 
             for team_name in team_names:
-                found = False
-                for captain in db['captains'].values():
-                    if captain.team and team_name == captain.team.name:
-                        players.append(captain)
-                        found = True
-                        break
-
-                if not found:
+                captain = self.find_captain(db, team_name=team_name)
+                if captain and captain.team:
+                    players.append(captain)
+                else:
                     await self.reply(message, ':warning: Cannot find player from team "{}"'.format(team_name))
 
         else:
@@ -1456,13 +1808,7 @@ class RoleKeeper:
         if not channel_name:
             return False, None
 
-        category = None
-        if 'categories' in self.config['guilds'][guild.name] \
-           and cat_id in self.config['guilds'][guild.name]['categories']:
-            cat_name = self.config['guilds'][guild.name]['categories'][cat_id]
-            for ch in guild.channels:
-                if cat_name.lower() in ch.name.lower():
-                    category = ch
+        category = self.get_category(guild, cat_id)
 
         if cat_id and len(cat_id) > 0 and not category:
             await self.reply(message, ':warning: Cannot find category with ID "{}"'.format(cat_id))
@@ -1482,10 +1828,11 @@ class RoleKeeper:
                     if captain.member:
                         overrides[captain.member] = read_perms
 
-                channel = await guild.create_text_channel(
+                channel = await self.outbound.call('channel', guild.id, guild.create_text_channel,
                     channel_name,
                     overwrites=overrides,
                     category=category)
+                self.index_channel(channel)
 
                 print('Created channel "<{channel}>"'\
                       .format(channel=channel_name))
@@ -1494,7 +1841,7 @@ class RoleKeeper:
                       .format(channel=channel_name))
 
             try:
-                await channel.edit(topic=topic)
+                await self.outbound.call('channel', channel.guild.id, channel.edit, topic=topic)
 
                 print('Set topic for channel "<{channel}>" to "{topic}"'\
                       .format(channel=channel_name, topic=topic))
@@ -1507,6 +1854,7 @@ class RoleKeeper:
 
         # Start the match
         db['matches'][channel_name] = match
+        self.index_match(guild, db, channel)
         handle = Handle(self, channel=channel)
         await match.begin(handle)
 
@@ -1517,20 +1865,14 @@ class RoleKeeper:
     def is_captain_in_match(self, member, channel, force=False):
         guild = member.guild
 
-        if guild not in self.db:
-            return False
-
-        db, error, _ = self.find_cup_db(guild, match=channel.name)
-        if error:
-            return False
-
-        if channel.name not in db['matches']:
+        _, match = self.find_match(guild, channel)
+        if not match:
             return False
 
         if force:
             return True
 
-        return db['matches'][channel.name].is_in_match(member)
+        return match.is_in_match(member)
 
     # Ban a map
     async def ban_map(self, message, map_unsafe, force=False):
@@ -1538,15 +1880,12 @@ class RoleKeeper:
         channel = message.channel
         banned_map_safe = sanitize_input(translit_input(map_unsafe))
 
-        db, error, _ = self.find_cup_db(guild, match=channel.name)
-        if error:
-            return False
-
-        if channel.name not in db['matches']:
+        _, match = self.find_match(guild, channel)
+        if not match:
             return False
 
         handle = Handle(self, message=message)
-        return await db['matches'][channel.name].ban_map(handle, banned_map_safe, force)
+        return await match.ban_map(handle, banned_map_safe, force)
 
     # Pick a map
     async def pick_map(self, message, map_unsafe, force=False):
@@ -1554,15 +1893,12 @@ class RoleKeeper:
         channel = message.channel
         picked_map_safe = sanitize_input(translit_input(map_unsafe))
 
-        db, error, _ = self.find_cup_db(guild, match=channel.name)
-        if error:
-            return False
-
-        if channel.name not in db['matches']:
+        _, match = self.find_match(guild, channel)
+        if not match:
             return False
 
         handle = Handle(self, message=message)
-        return await db['matches'][channel.name].pick_map(handle, picked_map_safe, force)
+        return await match.pick_map(handle, picked_map_safe, force)
 
     # Choose sides
     async def choose_side(self, message, side_unsafe, force=False):
@@ -1570,45 +1906,36 @@ class RoleKeeper:
         channel = message.channel
         side_safe = sanitize_input(translit_input(side_unsafe))
 
-        db, error, _ = self.find_cup_db(guild, match=channel.name)
-        if error:
-            return False
-
-        if channel.name not in db['matches']:
+        _, match = self.find_match(guild, channel)
+        if not match:
             return False
 
         handle = Handle(self, message=message)
-        return await db['matches'][channel.name].choose_side(handle, side_safe, force)
+        return await match.choose_side(handle, side_safe, force)
 
     # Undo action
     async def undo_map(self, message):
         guild = message.author.guild
         channel = message.channel
 
-        db, error, _ = self.find_cup_db(guild, match=channel.name)
-        if error:
-            return False
-
-        if channel.name not in db['matches']:
+        _, match = self.find_match(guild, channel)
+        if not match:
             return False
 
         handle = Handle(self, message=message)
-        return await db['matches'][channel.name].undo_map(handle)
+        return await match.undo_map(handle)
 
     # Close a match
     async def close_match(self, message):
         guild = message.author.guild
         channel = message.channel
 
-        db, error, _ = self.find_cup_db(guild, match=channel.name)
-        if error:
-            return False
-
-        if channel.name not in db['matches']:
+        _, match = self.find_match(guild, channel)
+        if not match:
             return False
 
         handle = Handle(self, message=message)
-        return await db['matches'][channel.name].close_match(handle)
+        return await match.close_match(handle)
 
     # Broadcast information that the match is or will be streamed
     # 1. Notify captains match will be streamed
@@ -1618,7 +1945,7 @@ class RoleKeeper:
         guild = message.guild
 
         member = message.author if not streamer else streamer
-        channel = discord.utils.get(guild.channels, name=match_id)
+        channel = self.get_channel(guild, match_id)
         db, error, _ = self.find_cup_db(guild, match=match_id)
         match = db['matches'][match_id] if db and match_id in db['matches'] else None
 
@@ -1629,7 +1956,7 @@ class RoleKeeper:
             return False
 
         # 1. Notify captains match will be streamed
-        await channel.send(
+        await self.outbound.call('message', channel.id, channel.send,
             content=':eye::popcorn: _{} will stream this match!_ :movie_camera::satellite:\n'
             ':arrow_forward: _8.9. The teams whose match will be officially streamed will have '
             '**only** 10 minutes to assemble._\n'\
@@ -1645,7 +1972,7 @@ class RoleKeeper:
             # 2. Give permission to streamer to see match room
             overwrite = discord.PermissionOverwrite()
             overwrite.read_messages = True
-            await channel.set_permissions(member, overwrite=overwrite)
+            await self.outbound.call('permission', channel.id, channel.set_permissions, member, overwrite=overwrite)
 
             print('Gave permission to "{member}" to see channel "{channel}"'\
                   .format(channel=channel.name,
@@ -1666,7 +1993,7 @@ class RoleKeeper:
         guild = message.guild
 
         member = message.author if not streamer else streamer
-        channel = discord.utils.get(guild.channels, name=match_id)
+        channel = self.get_channel(guild, match_id)
         db, error, _ = self.find_cup_db(guild, match=match_id)
         match = db['matches'][match_id] if db and match_id in db['matches'] else None
 
@@ -1681,7 +2008,7 @@ class RoleKeeper:
             return False
 
         # 1. Notify captains match will not be streamed anymore
-        await channel.send(
+        await self.outbound.call('message', channel.id, channel.send,
             content=':door::walking: _{} will not stream this match anymore_\n'
             ':arrow_forward: You can start the match without him\n'\
             .format(md_bold(member.nick if member.nick else member.name)))
@@ -1694,7 +2021,7 @@ class RoleKeeper:
            and self.config['guilds'][guild.name]['streamer_can_see_match']:
 
             # 2. Remove permission from streamer to see match room
-            await channel.set_permissions(member, overwrite=None)
+            await self.outbound.call('permission', channel.id, channel.set_permissions, member, overwrite=None)
             print('Removed permission from "{member}" to see channel "{channel}"'\
                   .format(channel=channel.name,
                   member=str(member)))
@@ -1734,7 +2061,7 @@ class RoleKeeper:
                 continue
 
             try:
-                await team.role.delete()
+                await self.outbound.call('role', team.role.guild.id, team.role.delete)
                 print ('Deleted role "{role}"'\
                        .format(role=role_name))
             except:
@@ -1754,9 +2081,9 @@ class RoleKeeper:
             if current_time > time_start + 10:
                 time_start = current_time
                 try:
-                    await reply.edit(content='{reply}{percent}%'\
-                                     .format(reply=reply_txt,
-                                             percent=int((current_i/total)*100) ))
+                    await self.edit_message(reply, '{reply}{percent}%'\
+                                           .format(reply=reply_txt,
+                                                   percent=int((current_i/total)*100) ))
                 except:
                     pass
 
@@ -1782,7 +2109,8 @@ class RoleKeeper:
             # 4. Remove team captain and group roles from member
             if len(role_names) > 0:
                 try:
-                    await member.remove_roles(*role_list)
+                    await self.outbound.call('member', member.guild.id, member.remove_roles, *role_list)
+                    self.roles_changed(member, removed=role_list)
                     print ('Removed roles <{roles}> from "{member}"'\
                            .format(member=discord_id,
                                    roles=role_names))
@@ -1795,7 +2123,7 @@ class RoleKeeper:
             # 5. Reset member nickname
             if member.nick:
                 try:
-                    await member.edit(nick=None)
+                    await self.outbound.call('member', member.guild.id, member.edit, nick=None)
                     print ('Reset nickname for "{member}"'\
                            .format(member=discord_id))
                 except:
@@ -1803,10 +2131,11 @@ class RoleKeeper:
                            .format(member=discord_id))
 
         db['captains'].clear()
+        self.index_cup(guild, db)
 
-        await reply.edit(content='{mention} Deleted {count} teams.'\
-                         .format(mention=message.author.mention,
-                                 count=count))
+        await self.edit_message(reply, '{mention} Deleted {count} teams.'\
+                               .format(mention=message.author.mention,
+                                       count=count))
 
         return True
 
@@ -1831,6 +2160,7 @@ class RoleKeeper:
 
         if mode == self.WIPE_ALL:
             db['matches'].clear()
+            self.index[guild].matches.drop_cup(db['cup'].name)
 
         if mode != self.WIPE_AUTO:
             reply = await self.reply(message,
@@ -1841,7 +2171,7 @@ class RoleKeeper:
             reply = None
 
         for channel_name, match in matches:
-            channel = discord.utils.get(guild.channels, name=channel_name)
+            channel = self.get_channel(guild, channel_name)
 
             if not channel:
                 count = count - 1
@@ -1858,7 +2188,7 @@ class RoleKeeper:
                 continue
 
             try:
-                await channel.delete()
+                await self.outbound.call('channel', channel.guild.id, channel.delete)
                 print ('Deleted channel "{channel}"'\
                        .format(channel=channel_name))
             except:
@@ -1866,9 +2196,9 @@ class RoleKeeper:
                        .format(channel=channel_name))
 
         if reply:
-            await reply.edit(content='{mention} Deleted {count} matches.'\
-                             .format(mention=message.author.mention,
-                                     count=count))
+            await self.edit_message(reply, '{mention} Deleted {count} matches.'\
+                                   .format(mention=message.author.mention,
+                                           count=count))
 
         return True
 
@@ -1877,7 +2207,7 @@ class RoleKeeper:
         count = len(l)
         for msg in l:
             try:
-                await msg.delete()
+                await self.delete_message(msg)
             except:
                 count = count - 1
                 print('WARNING: No permission to delete in "{}"'.format(msg.channel.name))
@@ -1917,7 +2247,7 @@ class RoleKeeper:
             # Try to delete messages in bulk, if not older than 14 days
             try:
                 bulk_messages_to_delete = messages_to_delete[(i)*max_api_count:(i+1)*max_api_count]
-                await channel.delete_messages(bulk_messages_to_delete)
+                await self.outbound.call('delete', channel.id, channel.delete_messages, bulk_messages_to_delete)
                 count += len(bulk_messages_to_delete)
             except:
                 # If there is any error, try to delete them 1 by 1 instead
@@ -1926,9 +2256,9 @@ class RoleKeeper:
         # Finally delete old messages
         count += await self.delete_messages_one_by_one(old_messages_to_delete)
 
-        await reply.edit(content='{mention} Deleted {count} messages.'\
-                         .format(mention=message.author.mention,
-                                 count=count))
+        await self.edit_message(reply, '{mention} Deleted {count} messages.'\
+                               .format(mention=message.author.mention,
+                                       count=count))
         print ('Deleted {count} messages in "{channel}"'\
                .format(count=count, channel=channel.name))
 
@@ -1968,9 +2298,7 @@ class RoleKeeper:
                     count=member_count)
 
         try:
-            await message.channel.send(file=discord.File(fp=csv,
-                                                         filename=filename),
-                                       content=msg)
+            await self.send_file(message.channel, csv, filename, msg)
             print ('Sent member list ({})'.format(member_count))
         except Exception as e:
             print ('ERROR: Failed to send member list ({})'.format(member_count))
@@ -2038,9 +2366,7 @@ class RoleKeeper:
             .format(mention=message.author.mention)
 
         try:
-            await message.channel.send(file=discord.File(fp=csv,
-                                                         filename=filename),
-                                        content=msg)
+            await self.send_file(message.channel, csv, filename, msg)
             print ('Sent pick&ban stats')
         except Exception as e:
             print ('ERROR: Failed to send pick&ban stats')
@@ -2080,9 +2406,7 @@ class RoleKeeper:
             .format(mention=message.author.mention)
 
         try:
-            await message.channel.send(file=discord.File(fp=csv,
-                                                         filename=filename),
-                                        content=msg)
+            await self.send_file(message.channel, csv, filename, msg)
             print ('Sent captain list')
         except Exception as e:
             print ('ERROR: Failed to send captain list')
@@ -2253,7 +2577,7 @@ class RoleKeeper:
 
         else:
             await self.reply(message, 'I do not remember checking that cup and you did not attach a CSV file to check ¯\_(ツ)_/¯')
-            await reply.delete()
+            await self.delete_message(reply)
             return False
 
         members = list(guild.members)
@@ -2273,14 +2597,14 @@ class RoleKeeper:
             else:
                 await self.reply(message, 'Duplicate team: {}. Operation cancelled'\
                                  .format(captain.team_name))
-                await reply.delete()
+                await self.delete_message(reply)
                 return False
 
         for group, count in temp_check_groups.items():
             if count >= 100:
                 await self.reply(message, 'Too many teams in group: {}. Operation cancelled'\
                                  .format(group))
-                await reply.delete()
+                await self.delete_message(reply)
                 return False
 
         # Maximum of 250 roles in a given guild
@@ -2292,7 +2616,7 @@ class RoleKeeper:
 
             if db_error:
                 await self.reply(message, db_error)
-                await reply.delete()
+                await self.delete_message(reply)
                 return False
 
             db['with_roles'] = can_create_roles
@@ -2310,17 +2634,18 @@ class RoleKeeper:
 
             if len(captains_by_nick) != len(captains):
                 await self.reply(message, 'Duplicate Nickname(s)')
-                await reply.delete()
+                await self.delete_message(reply)
                 return False
 
             if len(captains_by_team) != len(captains):
                 await self.reply(message, 'Duplicate Team name(s)')
-                await reply.delete()
+                await self.delete_message(reply)
                 return False
 
             db['captains'] = captains
             db['captains-by-nick'] = captains_by_nick
             db['captains-by-team'] = captains_by_team
+            self.index_cup(guild, db)
 
             db['groups'] = groups # TODO cup-ref?
 
@@ -2338,6 +2663,7 @@ class RoleKeeper:
                 del self.checked_cups[cup_name]
 
         # Collect missing captain Discords
+        member_index = MemberIndex(members)
         missing_discords = []
         invalid_discords = []
         missing_members = []
@@ -2349,9 +2675,9 @@ class RoleKeeper:
             if current_time > time_start + 10:
                 time_start = current_time
                 try:
-                    await reply.edit(content='{reply}{percent}%'\
-                                     .format(reply=reply_txt,
-                                             percent=int((current_i/total)*100) ))
+                    await self.edit_message(reply, '{reply}{percent}%'\
+                                           .format(reply=reply_txt,
+                                                   percent=int((current_i/total)*100) ))
                 except:
                     pass
 
@@ -2367,7 +2693,8 @@ class RoleKeeper:
                                                 t=md_inline_code(captain.team_name),
                                                 d=md_inline_code(captain.discord),
                                                 g=group_s))
-            elif not discord.utils.find(lambda m: captain.member and str(m) == str(captain.member) or str(m) == captain.discord, members):
+            elif not (captain.member and captain.member in member_index) \
+                 and not member_index.get(captain.discord):
                 missing_members.append('{n} (Team {t}{g}): {d}'\
                                        .format(n=md_inline_code(captain.nickname),
                                                t=md_inline_code(captain.team_name),
@@ -2391,8 +2718,7 @@ class RoleKeeper:
             filename = 'check-{}-{}.txt'.format(self.config['guilds'][guild.name]['db'], cup_name)
 
             try:
-                await message.channel.send(file=discord.File(fp=csv,
-                                                             filename=filename))
+                await self.send_file(message.channel, csv, filename)
             except Exception as e:
                 print ('ERROR: Failed to send report')
 
@@ -2432,7 +2758,7 @@ class RoleKeeper:
 
         #await self.reply(message, report)
         await self.embed(message, title, body)
-        await reply.delete()
+        await self.delete_message(reply)
 
         return True
 
@@ -2600,6 +2926,11 @@ class RoleKeeper:
 
         self.config = self.get_config(self.config_file)
 
+        # Special role names may have changed
+        if self.config:
+            for guild in list(self.index.keys()):
+                self.cache_special_roles(guild)
+
         return self.config != None
 
     ## Open captain hunt
@@ -2622,6 +2953,7 @@ class RoleKeeper:
         # TODO Welcome message?
 
         db['hunt'] = hunt
+        self.index[guild].hunts.add(channel.id, db['cup'].name)
 
         return True
 
@@ -2646,9 +2978,9 @@ class RoleKeeper:
 
         # If no match, gently delete the message after 5 seconds
         if (not matching_nickname) and (not matching_teamname):
-            await message.add_reaction('\N{NO ENTRY}')
+            await self.outbound.call('reaction', message.channel.id, message.add_reaction, '\N{NO ENTRY}')
             await asyncio.sleep(5)
-            await message.delete()
+            await self.delete_message(message)
             return
 
         # Look up in team names first
@@ -2673,7 +3005,7 @@ class RoleKeeper:
             ret = False
 
 
-        await message.add_reaction('\N{WHITE HEAVY CHECK MARK}' if ret else '\N{NO ENTRY}')
+        await self.outbound.call('reaction', message.channel.id, message.add_reaction, '\N{WHITE HEAVY CHECK MARK}' if ret else '\N{NO ENTRY}')
 
     ## Close captain hunt
     async def stop_hunt(self, message, cup_name):
@@ -2690,6 +3022,7 @@ class RoleKeeper:
         # TODO Goodbye message?
 
         del db['hunt']
+        self.index[guild].hunts.drop_cup(db['cup'].name)
 
         return True
 
@@ -2732,27 +3065,37 @@ class RoleKeeper:
             group_role = await self.get_or_create_role(guild, group.name, color=role_color)
             group.role = group_role
 
+        # Existing captains by discord ID, nickname and team name, so that
+        # each row of the CSV is matched with a single lookup
+        by_discord = {}
+        by_nick = {}
+        by_team = {}
+        for key, cpt in db['captains'].items():
+            if len(cpt.discord) > 0:
+                by_discord.setdefault(cpt.discord, (key, cpt))
+            by_nick.setdefault(cpt.nickname, (key, cpt))
+            by_team.setdefault(cpt.team_name, (key, cpt))
+
+        changes = {
+            'added': [],
+            'renamed': [],
+            'rekeyed': [],
+            'moved': [],
+        }
+
         remove_discord_list = []
         update_discord_list = []
         update_group_list = []
+        rekeyed_list = []
         count = 0
         for new_key, new_captain in captains.items():
-            old_captain = None
-            old_key = None
-
-            for old_key, cpt in db['captains'].items():
-                # No discord id change
-                if len(new_captain.discord) > 0 and cpt.discord == new_captain.discord:
-                    old_captain = cpt
-                    break
-                # Try to find him via nickname
-                elif cpt.nickname == new_captain.nickname:
-                    old_captain = cpt
-                    break
-                # then by team name (TODO can be several captains per team)
-                elif cpt.team_name == new_captain.team_name:
-                    old_captain = cpt
-                    break
+            # Find him by discord id, then nickname, then team name (TODO can
+            # be several captains per team)
+            old_key, old_captain = \
+                (len(new_captain.discord) > 0 and by_discord.get(new_captain.discord)) \
+                or by_nick.get(new_captain.nickname) \
+                or by_team.get(new_captain.team_name) \
+                or (None, None)
 
             # We still didn't find him, means he is new
             if not old_captain:
@@ -2761,12 +3104,36 @@ class RoleKeeper:
                 team = await self.create_team(guild, db, new_captain.team_name)
                 new_captain.team = team
                 update_discord_list.append(new_captain)
+
+                if len(new_captain.discord) > 0:
+                    by_discord[new_captain.discord] = (new_key, new_captain)
+                by_nick[new_captain.nickname] = (new_key, new_captain)
+                by_team[new_captain.team_name] = (new_key, new_captain)
+                db['captains-by-nick'][new_captain.nickname] = new_captain
+                db['captains-by-team'][new_captain.team_name] = new_captain
+                self.index_captain(guild, db, new_captain)
+
+                changes['added'].append({ 'nickname': new_captain.nickname,
+                                          'team': new_captain.team_name,
+                                          'discord': new_captain.discord })
                 print('Add captain "{nick}" for team "{team}"'\
                       .format(nick=new_captain.nickname,
                               team=new_captain.team_name))
             elif old_captain.nickname != new_captain.nickname:
+                old_nickname = old_captain.nickname
                 old_captain.nickname = new_captain.nickname
                 update_discord_list.append(old_captain)
+
+                if by_nick.get(old_nickname, (None, None))[1] is old_captain:
+                    del by_nick[old_nickname]
+                by_nick[old_captain.nickname] = (old_key, old_captain)
+                if db['captains-by-nick'].get(old_nickname) is old_captain:
+                    del db['captains-by-nick'][old_nickname]
+                db['captains-by-nick'][old_captain.nickname] = old_captain
+
+                changes['renamed'].append({ 'team': old_captain.team_name,
+                                            'from': old_nickname,
+                                            'to': old_captain.nickname })
                 print('Rename captain "{nick}" of team "{team}"'\
                       .format(nick=new_captain.nickname,
                               team=new_captain.team_name))
@@ -2776,6 +3143,7 @@ class RoleKeeper:
             if old_captain:
                 # ... and his discord id is different
                 if new_captain.discord != old_captain.discord:
+                    old_discord = old_captain.discord
 
                     # Update key in DB
                     db['captains'][new_key] = old_captain
@@ -2793,7 +3161,19 @@ class RoleKeeper:
                     old_captain.discord = new_captain.discord
                     old_captain.member = None
                     update_discord_list.append(old_captain)
-
+                    rekeyed_list.append(old_captain)
+
+                    if by_discord.get(old_discord, (None, None))[1] is old_captain:
+                        del by_discord[old_discord]
+                    if len(old_captain.discord) > 0:
+                        by_discord[old_captain.discord] = (new_key, old_captain)
+                    by_nick[old_captain.nickname] = (new_key, old_captain)
+                    by_team[old_captain.team_name] = (new_key, old_captain)
+                    self.index_captain(guild, db, old_captain)
+
+                    changes['rekeyed'].append({ 'nickname': old_captain.nickname,
+                                                'from': old_discord,
+                                                'to': old_captain.discord })
                     print ('Updated discord id for "{cpt}" to "{id}"'\
                            .format(cpt=old_captain.nickname,
                                    id=old_captain.discord))
@@ -2803,6 +3183,10 @@ class RoleKeeper:
                     old_group = old_captain.group
                     old_captain.group = new_captain.group
                     update_group_list.append(old_captain)
+
+                    changes['moved'].append({ 'nickname': old_captain.nickname,
+                                              'from': old_group.id if old_group else None,
+                                              'to': old_captain.group.id if old_captain.group else None })
                     print ('Changed group from {A} to {B} for "{cpt}"'\
                            .format(A=old_group.id if old_group else None,
                                    B=old_captain.group.id if old_captain.group else None,
@@ -2812,8 +3196,11 @@ class RoleKeeper:
                     if old_captain.member:
                         # Change group role for member
                         try:
-                            await old_captain.member.remove_roles(old_group.role)
-                            await old_captain.member.add_roles(old_captain.group.role)
+                            await self.outbound.call('member', old_captain.member.guild.id, old_captain.member.remove_roles, old_group.role)
+                            await self.outbound.call('member', old_captain.member.guild.id, old_captain.member.add_roles, old_captain.group.role)
+                            self.roles_changed(old_captain.member,
+                                               added=[ old_captain.group.role ],
+                                               removed=[ old_group.role ])
 
                             print ('Changed role <{roleA}> to <{roleB}> from "{member}"'\
                                    .format(member=old_captain.discord,
@@ -2830,9 +3217,9 @@ class RoleKeeper:
         captain_set.update(update_group_list)
         count = len(captain_set)
 
-        members = list(guild.members)
+        member_index = MemberIndex(guild.members)
         for captain in update_discord_list:
-            member = discord.utils.find(lambda m: str(m) == captain.discord, members)
+            member = member_index.get(captain.discord)
             if member:
                 await self.handle_member_join(member, db)
 
@@ -2840,17 +3227,23 @@ class RoleKeeper:
             print('Remove captain {}'.format(str(member)))
             await self.remove_captain(message, guild, member, cup_name)
 
-        # Rebuild indexes
-        db['captains-by-nick'] = { c.nickname: c for c in db['captains'].values() }
-        db['captains-by-team'] = { c.team_name: c for c in db['captains'].values() }
+        # Removing the previous member of a captain also removed him from the
+        # indexes
+        for captain in rekeyed_list:
+            if db['captains'].get(captain.key) is captain:
+                db['captains-by-nick'][captain.nickname] = captain
+                db['captains-by-team'][captain.team_name] = captain
 
-        await reply.edit(content='{mention} Updated {count} captains.'\
-                        .format(mention=message.author.mention,
-                                count=count))
-        print ('Updated {count} captains'\
-               .format(count=count))
+        await self.edit_message(reply, '{mention} Updated {count} captains '
+                               '({added} added, {renamed} renamed, {rekeyed} new discord IDs, {moved} moved).'\
+                              .format(mention=message.author.mention,
+                                      count=count,
+                                      **{ k: len(v) for k, v in changes.items() }))
+        print ('Updated {count} captains: {changes}'\
+               .format(count=count,
+                       changes=json.dumps(changes)))
 
-        return True
+        return changes
 
     # Save players CSID for the cup (for rewards)
     async def set_players(self, message, cup_name, players_csv):
@@ -2877,6 +3270,7 @@ class RoleKeeper:
             return False
 
         db['players'] = in_players
+        self.index[guild].players.update_cup(db['cup'].name, in_players)
 
         return True
 
@@ -2908,7 +3302,7 @@ class RoleKeeper:
             return False
 
         if players_csv:
-            if not await set_players(self, message, cup_name, players_csv):
+            if not await self.set_players(message, cup_name, players_csv):
                 return False
 
         if not 'players' in db or not db['players'] or len(db['players']) == 0:
@@ -2989,7 +3383,7 @@ class RoleKeeper:
             await handle.react(r)
         await handle.react(self.REACT_READY)
 
-        self.register_reaction_handler(handle.message, self.on_captain_reaction, captain=captain, db=db)
+        self.register_reaction_handler(handle.message.id, self.on_captain_reaction, captain=captain, db=db)
 
     def get_reward_message(self, db, captain, toolate=False):
         rewards_db = db['rewards'][captain]
@@ -3037,8 +3431,8 @@ When finished, click on :white_check_mark: and :pencil: to edit.
 
         await handle.unreact(reaction, user)
 
-        is_admin = message.author.guild_permissions.manage_roles
-        is_ref = discord.utils.get(message.author.roles, name=self.config['roles']['referee']['name']) or is_admin
+        member = message.guild.get_member(user.id)
+        _, is_ref, _ = self.get_permissions(member) if member else (False, False, False)
 
         if user != captain.member and not is_ref:
             print('INFO: User {} reacted but is not captain {}'.format(user, captain.member))
@@ -3059,12 +3453,12 @@ When finished, click on :white_check_mark: and :pencil: to edit.
                 return
         elif emoji == self.REACT_READY and rewards_db['ready']:
             #await handle.unreact(self.REACT_READY, message.author)
-            await handle.message.clear_reactions()
+            await handle.clear_reactions()
             await handle.react(self.REACT_CANCEL)
             db['rewards_modified'] = True
             rewards_db['validated'] = True
         elif emoji == self.REACT_CANCEL and rewards_db['validated']:
-            await handle.message.clear_reactions()
+            await handle.clear_reactions()
             #await handle.unreact(self.REACT_CANCEL, message.author)
             for r in rewards_db['reactions'].keys():
                 await handle.react(r)
@@ -3083,6 +3477,9 @@ When finished, click on :white_check_mark: and :pencil: to edit.
             await handle.unreact(self.REACT_READY, message.author)
             rewards_db['ready'] = False
 
+        # Changed in place, save it again
+        db['rewards'][captain] = rewards_db
+
         await handle.edit(self.get_reward_message(db, captain))
 
     # Export rewards lists decided by captains
@@ -3098,13 +3495,15 @@ When finished, click on :white_check_mark: and :pencil: to edit.
             return False
 
         if players_csv:
-            if not await set_players(self, message, cup_name, players_csv):
+            if not await self.set_players(message, cup_name, players_csv):
                 return False
 
         if not 'players' in db or not db['players'] or len(db['players']) == 0:
             await self.reply(message, 'Please attach a CSV to the command and try again. Or use !set_players')
             return False
 
+        players_index = self.index[guild].players
+
         reward_types = []
         for captain, rewards_db in db['rewards'].items():
             for prize_name in rewards_db['rewards'].keys():
@@ -3119,7 +3518,7 @@ When finished, click on :white_check_mark: and :pencil: to edit.
             players = rewards_db['players']
             distrib = rewards_db['distribution'] if rewards_db['ready'] else { players[i]: i < 5 for i in range(len(players)) }
             for player_name in players:
-                player = next(p for p in db['players'] if p['nickname'] == player_name)
+                player = players_index.find(db['cup'].name, db['players'], player_name)
                 r_for_p = rewards_db['rewards'].copy() \
                           if player_name in distrib and distrib[player_name] \
                              else {}
@@ -3136,9 +3535,7 @@ When finished, click on :white_check_mark: and :pencil: to edit.
 
         msg = 'Here is the reward list'
         try:
-            await message.channel.send(file=discord.File(fp=out_csv,
-                                                         filename=filename),
-                                       content=msg)
+            await self.send_file(message.channel, out_csv, filename, msg)
             print ('Sent reward list')
         except Exception as e:
             print ('ERROR: Failed to send reward list')
@@ -3168,10 +3565,11 @@ When finished, click on :white_check_mark: and :pencil: to edit.
 
         for captain, rewards_db in db['rewards'].items():
             handle = rewards_db['handle']
-            if handle and handle.message:
-                self.unregister_reaction_handler(handle.message)
+            if handle and handle.message_id:
+                self.unregister_reaction_handler(handle.message_id)
                 try:
-                    await handle.message.clear_reactions()
+                    await handle.restore()
+                    await handle.clear_reactions()
                     await handle.edit(self.get_reward_message(db, captain, toolate=True))
                 except:
                     pass
@@ -3183,11 +3581,14 @@ When finished, click on :white_check_mark: and :pencil: to edit.
         return True
 
     async def on_reaction_event(self, event, reaction, message, user):
+        if message.guild and self.check_guild(message.guild):
+            await self.use_guild(message.guild)
+
         if message.id in self.reaction_handlers:
             d = self.reaction_handlers[message.id]
             await d['cb'](event, reaction, user, message, *d['a'], **d['kw'])
 
-    def register_reaction_handler(self, message, callback, *args, **kwargs):
-        self.reaction_handlers[message.id] = { 'cb': callback, 'a': args, 'kw': kwargs }
-    def unregister_reaction_handler(self, message):
-        del self.reaction_handlers[message.id]
+    def register_reaction_handler(self, message_id, callback, *args, **kwargs):
+        self.reaction_handlers[message_id] = { 'cb': callback, 'a': args, 'kw': kwargs }
+    def unregister_reaction_handler(self, message_id):
+        del self.reaction_handlers[message_id]
@@ -21,8 +21,13 @@
 
 import discord
 
+from tracked import Tracked, TrackedDict
+
 ### Class that holds information about a role and a custom name
-class CustomRole:
+class CustomRole(Tracked):
+    # Version of the state saved by __getstate__
+    STATE_VERSION = 1
+
     def __init__(self, name, role):
         self.name = name
         self.role = role
@@ -33,12 +38,18 @@ class CustomRole:
 
     ## Override pickle serialization
     def __getstate__(self):
-        state = {
-            'name': self.name,
-            '_role_id': self.role.id if hasattr(self, 'role') and self.role else self._role_id,
-        }
+        return (self.STATE_VERSION,
+                self.name,
+                self.role.id if hasattr(self, 'role') and self.role \
+                else getattr(self, '_role_id', None))
+
+    def __setstate__(self, state):
+        # Saved by an older version
+        if isinstance(state, dict):
+            self.__dict__.update(state)
+            return
 
-        return state
+        self.__dict__.update(name=state[1], _role_id=state[2])
 
     async def resume(self, guild, bot, db):
         if hasattr(self, '_role_id'):
@@ -53,12 +64,12 @@ class Cup(CustomRole):
 
     ## Override pickle serialization
     def __getstate__(self):
-        state = super().__getstate__()
-        state.update({
-            'maps_key': self.maps_key
-        })
+        return super().__getstate__() + (self.maps_key,)
 
-        return state
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        if not isinstance(state, dict):
+            self.__dict__['maps_key'] = state[3]
 
 ### Class that holds information about a group
 class Group(CustomRole):
@@ -71,12 +82,12 @@ class Group(CustomRole):
 
     ## Override pickle serialization
     def __getstate__(self):
-        state = super().__getstate__()
-        state.update({
-            'id': self.id
-        })
+        return super().__getstate__() + (self.id,)
 
-        return state
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        if not isinstance(state, dict):
+            self.__dict__['id'] = state[3]
 
 ### Class that holds information about a team
 class Team(CustomRole):
@@ -94,15 +105,24 @@ class Team(CustomRole):
 
     ## Override pickle serialization
     def __getstate__(self):
-        state = super().__getstate__()
-        state.update({
-            'captains': self.captains
-        })
+        return super().__getstate__() + (tuple(self.captains.items()),)
 
-        return state
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        if not isinstance(state, dict):
+            self.__dict__['captains'] = dict(state[3])
+
+    # Adding or removing a captain changes the team too
+    def track(self, touch):
+        super().track(touch)
+        self.__dict__['captains'] = TrackedDict(lambda key: touch(), self.captains)
 
 ### Class that holds information about a team captain
-class TeamCaptain:
+class TeamCaptain(Tracked):
+    # Version of the state saved by __getstate__, and its fields
+    STATE_VERSION = 1
+    STATE_FIELDS = ( 'discord', 'team_name', 'nickname', 'group', 'cup', 'team', 'key', '_member_id' )
+
     def __init__(self, discord, team_name, nickname, group, cup):
         self.discord = discord
         self.team_name = team_name
@@ -130,22 +150,27 @@ class TeamCaptain:
 
     ## Override pickle serialization
     def __getstate__(self):
-        state = {
-            'discord': self.discord,
-            'team_name': self.team_name,
-            'nickname': self.nickname,
-            'group': self.group,
-            'cup': self.cup,
-            'team': self.team,
-            'key': self.key,
-            '_member_id': self.member.id \
-                            if hasattr(self, 'member') and self.member \
-                            else self._member_id \
-                              if hasattr(self, '_member_id') \
-                              else None
-        }
-
-        return state
+        return (self.STATE_VERSION,
+                self.discord,
+                self.team_name,
+                self.nickname,
+                self.group,
+                self.cup,
+                self.team,
+                self.key,
+                self.member.id \
+                if hasattr(self, 'member') and self.member \
+                else self._member_id \
+                  if hasattr(self, '_member_id') \
+                  else None)
+
+    def __setstate__(self, state):
+        # Saved by an older version
+        if isinstance(state, dict):
+            self.__dict__.update(state)
+            return
+
+        self.__dict__.update(zip(self.STATE_FIELDS, state[1:]))
 
     async def resume(self, guild, bot, db):
         if hasattr(self, '_member_id'):
@@ -0,0 +1,97 @@
+# The MIT License (MIT)
+# Copyright (c) 2017 Levak Borok <levak92@gmail.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+
+## Change tracking of the objects saved in the DB, so that only what changed
+## gets written to the disk.
+
+### Object that tells its owner whenever one of its attributes changes
+class Tracked:
+    # Attributes saved in the DB, all of them if None
+    TRACKED = None
+
+    # Attributes not saved in the DB, changing them is not a change
+    UNTRACKED = ()
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+
+        if (self.TRACKED is None or name in self.TRACKED) \
+           and name not in self.UNTRACKED:
+            touch = self.__dict__.get('_touch')
+            if touch:
+                touch()
+
+    ## Override pickle serialization
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state.pop('_touch', None)
+
+        return state
+
+    def track(self, touch):
+        object.__setattr__(self, '_touch', touch)
+
+### Dictionary that tells its owner whenever it changes
+class TrackedDict(dict):
+    def __init__(self, touch, items={}, adopt=None):
+        dict.__init__(self)
+        self.touch = touch
+        self.adopt = adopt
+
+        for key, value in items.items():
+            dict.__setitem__(self, key, self.adopt(key, value) if self.adopt else value)
+
+    # Pickle it as a plain dict
+    def __reduce__(self):
+        return (dict, (dict(self),))
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, self.adopt(key, value) if self.adopt else value)
+        self.touch(key)
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self.touch(key)
+
+    def setdefault(self, key, value=None):
+        if key not in self:
+            self[key] = value
+        return dict.__getitem__(self, key)
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def pop(self, key, *args):
+        if key in self:
+            self.touch(key)
+        return dict.pop(self, key, *args)
+
+    def popitem(self):
+        key, value = dict.popitem(self)
+        self.touch(key)
+        return key, value
+
+    def clear(self):
+        keys = list(self.keys())
+        dict.clear(self)
+        for key in keys:
+            self.touch(key)